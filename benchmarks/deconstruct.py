@@ -0,0 +1,65 @@
+"""
+Compares ``djangocore.utils.deconstruct`` with the implementation it replaced,
+on a list page of 500 records in the wire format:
+
+    python benchmarks/deconstruct.py [records] [repeat]
+
+"""
+import os
+import sys
+import datetime
+import decimal
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.utils.encoding import force_unicode
+
+from djangocore.utils import deconstruct, PrimitiveList
+
+def deconstruct_chain(item):
+    """The isinstance chain that deconstruct used to be."""
+    if isinstance(item, dict):
+        return dict([(k, deconstruct_chain(v)) for k, v in item.iteritems()])
+    elif isinstance(item, decimal.Decimal):
+        return str(item)
+    elif hasattr(item, '__iter__'):
+        return [deconstruct_chain(v) for v in item]
+    elif callable(item):
+        return None
+    else:
+        return force_unicode(item, strings_only=True)
+
+def page(records):
+    return [{
+        'pk': i,
+        'model': u'polls.choice',
+        'fields': {
+            'poll': i % 10,
+            'answer': u'Answer %d' % i,
+            'votes': i * 3,
+            'ratio': i / 7.0,
+            'open': i % 2 == 0,
+            'closed': None,
+            'price': decimal.Decimal('%d.50' % i),
+            'created': datetime.datetime(2010, 1, 1, 12, 0, i % 60),
+            'tags': [1, 2, 3],
+        },
+    } for i in range(records)]
+
+def main(records=500, repeat=200):
+    data = page(records)
+    primitive = PrimitiveList(deconstruct(data))
+    assert deconstruct(data) == deconstruct_chain(data)
+
+    for name, function, payload in (
+            ('isinstance chain', deconstruct_chain, data),
+            ('type dispatch', deconstruct, data),
+            ('PrimitiveList', deconstruct, primitive)):
+        seconds = min(timeit.repeat(lambda: function(payload), number=repeat,
+            repeat=3)) / repeat
+        print "%-18s %10.3f ms per page of %d records" % (name,
+            seconds * 1000, records)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
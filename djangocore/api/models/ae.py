@@ -6,8 +6,10 @@ from google.appengine.ext.db.djangoforms import ModelForm, ModelFormMetaclass
 from django.http import HttpResponse, HttpResponseBadRequest
 
 # Intra-app dependencies.
-from djangocore.api.models.base import BaseModelResource
-from djangocore.serialization import emitter, EmittableResponse
+from djangocore.api.models.base import BaseModelResource, iterable
+from djangocore.api.models.query_translator import translator, \
+    datastore_compiler, QueryError
+from djangocore.serialization import EmittableResponse
 
 def modelform_factory(model, form=ModelForm, fields=None, exclude=None,
                        formfield_callback=lambda f: f.formfield()):
@@ -56,9 +58,16 @@ class AppEngineModelResource(BaseModelResource):
         'not': '!=',
         'in': 'IN',
     }
+    query_cache_size = 256 # The number of compiled conditions to keep around.
 
     def __init__(self, *args, **kwargs):
         super(AppEngineModelResource, self).__init__(*args, **kwargs)
+
+        # Datastore models have no django fields to coerce values to, so the
+        # translator only parses the conditions, and the datastore compiler
+        # turns them into filters.
+        self.translator = translator(cache_size=self.query_cache_size)
+        self.compiler = datastore_compiler(self.translator, key=Key)
         
         if not self.form:
             if self.fields:
@@ -76,13 +85,12 @@ class AppEngineModelResource(BaseModelResource):
             return response
         
         if isinstance(response, Query):
-            response = self.serialize_models(response)
+            response = self.serialize_models(response, request)
         
 
         # TODO: how do we catch bad format requests?
-        format = request.GET.get('format', 'json')
-        response = emitter.translate(format, response)
-        return response
+        return super(AppEngineModelResource, self).process_response(response,
+            request)
 
     def process_lookups(self, lookups):
         """
@@ -94,23 +102,58 @@ class AppEngineModelResource(BaseModelResource):
             if '__' in k:
                 l = k.rsplit(self.lookup_delimiter, 1)
                 n = self.lookup_mapper.get(l[-1], '')
-                k = '%s %s' % (l, n)
+                k = '%s %s' % (l[0], n)
             newlookups[str(k)] = v
         return newlookups
     
+    def get_query_set(self, request):
+        return self.model.all()
+
+    def filter_query(self, qs, lookups):
+        """
+        Applies the conditions, or the lookups if there are no conditions, as
+        datastore filters. Returns the filtered query and the filters.
+        
+        Raises a QueryError for conditions the datastore can't run.
+        
+        """
+        # The output format is handled by process_response.
+        lookups.pop('format', None)
+        lookups.pop('pretty', None)
+        lookups.pop('layout', None)
+
+        plan, parameters = self.process_conditions(lookups)
+        if plan is not None:
+            filters = self.compiler.compile(plan, parameters)
+        else:
+            filters = self.process_lookups(lookups).items()
+
+        for k, v in filters:
+            qs = qs.filter(k, v)
+        return qs, filters
+
     def length(self, request):
-        lookups = request.GET.copy()
-        max_count = lookups.pop('max', 0)
+        lookups = self.get_lookups(request)
+        max_count = int(iterable(lookups.pop('max', 0)))
+        lookups.pop('relations', None)
 
-        qs = self.get_query_set(request).order('__key__')
+        qs = self.get_query_set(request)
 
         try:
             # Catch any lookup errors here and return them to the client.
-            for k, v in self.process_lookups(lookups):
-                qs = qs.filter(k, v)
-        except PropertyError, err:
+            qs, filters = self.filter_query(qs, lookups)
+        except (PropertyError, QueryError), err:
             return EmittableResponse(str(err), status=400)
 
+        orders = self.compiler.orders(filters)
+        if orders:
+            # Inequality filters have to be sorted on their field first, so
+            # we can't walk the keys below, and walk the query with cursors.
+            for o in orders:
+                qs = qs.order(o)
+            return self.count_with_cursors(qs, max_count)
+
+        qs = qs.order('__key__')
         total_count = last_count = qs.count(1000)
         while last_count == 1000:
             # If the client specified a max count parameter, then we stop
@@ -127,33 +170,58 @@ class AppEngineModelResource(BaseModelResource):
             return max_count
             
         return total_count
+
+    def count_with_cursors(self, qs, max_count=0):
+        """
+        Counts the results of a query in batches of 1000 keys, continuing
+        each batch at the cursor of the one before it, up to max_count
+        results if given.
+        
+        """
+        total_count = 0
+        cursor = None
+        while not max_count or total_count < max_count:
+            qs.with_cursor(cursor)
+            last_count = len(qs.fetch(1000, keys_only=True))
+            total_count += last_count
+            if last_count < 1000:
+                break
+            cursor = qs.cursor()
+
+        if max_count and total_count >= max_count:
+            return max_count
+
+        return total_count
     
     def list(self, request):
-        lookups = request.GET.copy()
+        lookups = self.get_lookups(request)
+        lookups.pop('relations', None)
         qs = self.get_query_set(request)
 
-        ordering = lookups.pop('ordering', None)
+        ordering = iterable(lookups.pop('ordering', None))
         if ordering:
             ordering = ordering.split(',')            
             if len(ordering) > self.max_orderings:
                 return EmittableResponse("This model cannot be ordered by more "
                     "than %d parameter(s). You tried to order by %d parameters."
                     % (self.max_orderings, len(ordering)), status=400)
+        else:
+            ordering = []
             
-            for o in ordering:
-                qs = qs.order(o)
-            
-        offset = lookups.pop('offset', 0)
-        limit = min(lookups.pop('limit', self.max_objects), self.max_objects)
+        offset = int(iterable(lookups.pop('offset', 0)))
+        limit = min(int(iterable(lookups.pop('limit', self.max_objects))),
+            self.max_objects)
         
         try:
             # Catch any lookup errors here and return them to the client.
-            for k, v in self.process_lookups(lookups):
-                qs = qs.filter(k, v)
-        except PropertyError, err:
+            qs, filters = self.filter_query(qs, lookups)
+        except (PropertyError, QueryError), err:
             return EmittableResponse(str(err), status=400)
+
+        for o in self.compiler.orders(filters, ordering):
+            qs = qs.order(o)
         
-        return self.serialize_models(qs.fetch(limit, offset))
+        return self.serialize_models(qs.fetch(limit, offset), request)
     
     def show(self, request):
         pk_list = request.GET.getlist('pk')
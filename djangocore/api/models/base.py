@@ -5,12 +5,29 @@ from django.conf.urls.defaults import patterns, url, include
 # Intra-app dependencies.
 from djangocore.api.resources import BaseResource
 from djangocore.transform.forms import transformer
+from djangocore.api.models.query_translator import QueryError
 from product_database.models import *
 
 import django.db.models as djmodels
 import inspect
 import json
 
+from urllib import unquote_plus
+
+def iterable(obj):
+    """django nowadays plants all vars in lists. 
+    i.e.
+    <QueryDict: {u'ordering': [u'name'], u'limit': [u'0'], u'conditions': [u'ipPublic = {ipp} AND ipUmts = {ipu}'], u'parameters': [u'ipp=192.168.1.1,ipu=frank,'], u'offset': [u'0']}>
+    Thus, this function detects lists and returns the first object, if possible
+    """
+    if hasattr(obj, '__getitem__'):
+        if len(obj)>0:
+            return obj[0]
+        else:
+            return obj
+    else:
+        return obj
+
 class BaseModelResource(BaseResource):
     max_orderings = 1 # max number of order parameters for a query
     max_objects = 500 # max number of objects returned by a query
@@ -30,8 +47,13 @@ class BaseModelResource(BaseResource):
     def get_urls(self):
         from django.conf.urls.defaults import patterns, url
         urlpatterns = patterns('',
-            url('^length/$',    self.mapper,    self.ops(get='length')),
-            url('^list/$',      self.mapper,    self.ops(get='list')),
+            url('^length/$',    self.mapper,    self.ops(get='length', \
+              post='length')),
+            url('^list/$',      self.mapper,    self.ops(get='list', \
+              post='list')),
+            url('^ranges/$',    self.mapper,    self.ops(get='ranges', \
+              post='ranges')),
+            url('^bulk/$',      self.mapper,    self.ops(post='bulk_show')),
             url('^form/$',      self.mapper,    self.ops(get='form')),
             url('^$',           self.mapper,    self.ops(get='show', \
               post='create', put='update', delete='destroy')),
@@ -47,13 +69,27 @@ class BaseModelResource(BaseResource):
         ops = self.model._meta
         return 'models/%s/%s/' % (ops.app_label, ops.module_name)
 
-    def serialize_models(self, model_or_iterable, request):
-        req = request.GET.copy()
+    def serialize_models(self, model_or_iterable, request, fields=None):
+        req = self.get_options(request)
         #print req
         """
         Convert a model (or list of models) into standard python types
-        for later serialization.
+        for later serialization. Only the given fields are serialized, if
+        given, otherwise the resource's fields. Requests with
+        ?layout=columns get the columns layout, where the resource has a
+        row serializer.
         """
+        if fields is None:
+            # The resource's fields, where an empty tuple exposes them all.
+            fields = self.fields or None
+
+        if not req.get('relations'):
+            # Models without exposed methods and relations don't need the
+            # serializer, if the resource has a compiled one.
+            serializer = self.get_row_serializer(fields)
+            if serializer is not None:
+                return serializer.serialize(model_or_iterable,
+                    columns=req.get('layout') == 'columns')
         
         iterable = True
         if not hasattr(model_or_iterable, '__iter__'):
@@ -84,13 +120,13 @@ class BaseModelResource(BaseResource):
 
         #now use the django serializaation, but line for line
         s = []
-        if self.fields:
+        if fields is not None:
             # Filter the model's fields, if the resource requires it.
             if len(exposedCalls)==0:
-                 s = serialize('json', model_or_iterable, fields=self.fields)
+                 s = serialize('json', model_or_iterable, fields=fields)
             else:
                 for d in model_or_iterable:
-                    sx = serialize('json', d, fields=self.fields)
+                    sx = serialize('json', [d], fields=fields)[0]
                     """ and add the custom method calls """
                     for name in exposedCalls:
                         if not sx.get("fields"): break
@@ -168,7 +204,10 @@ class BaseModelResource(BaseResource):
                 if req.has_key('relations'):
                     relations = {}                
                     if req['relations'] != "":                    
-                        org_rel = json.loads(req['relations'])                    
+                        org_rel = req['relations']
+                        if isinstance(org_rel, basestring):
+                            # POSTed queries can send the relations decoded.
+                            org_rel = json.loads(org_rel)
                         self.dict_keys_to_str(relations,org_rel)
                     
                     print relations.__class__
@@ -197,6 +236,14 @@ class BaseModelResource(BaseResource):
             #s = s[0]
         return s
     
+    def get_row_serializer(self, fields=None):
+        """
+        Returns a compiled serializer for the model's objects, or None if
+        they have to go through the serializer. See DjangoModelResource.
+        
+        """
+        return None
+
     def dict_keys_to_str(self,new_dict,org_dict):
         for key in org_dict.keys():
             new_key = str(key)
@@ -218,6 +265,52 @@ class BaseModelResource(BaseResource):
         """
         return dict([(str(k), v) for k, v in lookups.items()])
                 
+    def get_lookups(self, request):
+        """
+        Returns the lookups of a query, from the GET parameters or a POSTed
+        JSON object. See get_options.
+        
+        """
+        return self.get_options(request)
+
+    def process_conditions(self, lookups):
+        """
+        Pops the SC.Query `conditions` and `parameters` from the lookups and
+        compiles the conditions. Returns a (plan, parameters) tuple, where
+        the plan is None if there are no conditions. Raises a QueryError if
+        the conditions can't be parsed.
+        
+        """
+        conditions = iterable(lookups.pop('conditions', ""))
+        if conditions=="" or conditions==None or conditions==0:
+            return None, None
+
+        """ check if we have parameters """
+        parameters = iterable(lookups.pop('parameters', ""))
+        if parameters=="" or parameters==None:
+            parameters = {}
+        elif isinstance(parameters, dict):
+            """ typed parameters, from a JSON request body """
+            parameters = dict([(str(k), v) for k, v in parameters.items()])
+        elif parameters.lstrip().startswith("{"):
+            """ typed parameters, as a JSON object """
+            try:
+                parameters = json.loads(parameters)
+            except ValueError:
+                raise QueryError("The parameters are not a valid JSON object")
+            if not isinstance(parameters, dict):
+                raise QueryError("The parameters are not a valid JSON object")
+            parameters = dict([(str(k), v) for k, v in parameters.items()])
+        else:
+            """ the parameter format is 'ipp=192.168.1.1,ipu=frank,'
+            we need to create dicts from that."""
+            parameters = dict([x.split("=", 1) for x in parameters.split(",") if x.strip()!=""])
+        
+        """parse the conditions """
+        conditionsString = unquote_plus(conditions);
+
+        return self.translator.compile(conditionsString), parameters
+
     def get_query_set(self, request):
         return self.model._default_manager.all()
     
@@ -227,12 +320,18 @@ class BaseModelResource(BaseResource):
     def list(self, request):
         raise NotImplementedError
 
+    def ranges(self, request):
+        raise NotImplementedError
+
     def meta(self, request):
         return transformer.render(self.form)
 
     def show(self, request):
         raise NotImplementedError
 
+    def bulk_show(self, request):
+        raise NotImplementedError
+
     def create(self, request):
         raise NotImplementedError
 
@@ -0,0 +1,173 @@
+"""
+Counting the objects of a large table is one of the most expensive queries a
+resource runs, and data sources count on every scroll. This module caches the
+counts, keyed by the resource and the SQL of the filtered query.
+
+Every model has a generation that is part of the keys of its counts.
+post_save and post_delete advance the generation, so a saved or deleted object
+makes all counts of its model unreachable at once. The backends also remember
+when each generation last advanced, which resources use to validate
+conditional requests. Changes that send no signals (QuerySet.update and .delete, raw SQL,
+other processes for the local backend) and changes to related models that the
+conditions look at are only picked up once the entries expire, so every entry
+has a time to live.
+
+"""
+# Standard library dependencies.
+import time
+import uuid
+import hashlib
+import threading
+
+# Django dependencies.
+from django.db.models.signals import post_save, post_delete
+from django.db.models.sql.datastructures import EmptyResultSet
+
+# Intra-app dependencies.
+from djangocore.utils import LRUCache
+
+def model_label(model):
+    opts = model._meta
+    return "%s.%s" % (opts.app_label, opts.object_name.lower())
+
+class LocalCountCache(object):
+    """
+    Keeps the counts in an in-process LRU cache. Entries are lost on restart
+    and are not shared between processes. The counters of different
+    processes are told apart by the token of their backend.
+
+    """
+    def __init__(self, max_size=1024):
+        self.cache = LRUCache(max_size)
+        self.generations = {}
+        self.changes = {}
+        self.lock = threading.Lock()
+        self.token = uuid.uuid4().hex
+
+    def get(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        count, expires = entry
+        if expires is not None and expires < time.time():
+            self.cache.delete(key)
+            return None
+        return count
+
+    def set(self, key, count, ttl=None):
+        expires = ttl is not None and time.time() + ttl or None
+        self.cache.set(key, (count, expires))
+
+    def generation(self, label):
+        return self.generations.get(label, 0)
+
+    def changed(self, label):
+        return self.changes.get(label)
+
+    def invalidate(self, label):
+        self.lock.acquire()
+        try:
+            self.generations[label] = self.generations.get(label, 0) + 1
+            self.changes[label] = time.time()
+        finally:
+            self.lock.release()
+
+class DjangoCountCache(object):
+    """
+    Keeps the counts in one of the caches configured in settings.CACHES, so
+    they are shared between processes. The generations live in the same cache,
+    so a save in one process invalidates the counts of all of them. They are
+    random tokens rather than counters, since a counter that is evicted would
+    start over and bring back the counts of an earlier generation.
+
+    """
+    key_prefix = "djangocore.count."
+    token = ""
+
+    def __init__(self, alias="default"):
+        from django.core.cache import get_cache
+        self.cache = get_cache(alias)
+
+    def get(self, key):
+        return self.cache.get(self.key_prefix + key)
+
+    def set(self, key, count, ttl=None):
+        self.cache.set(self.key_prefix + key, count, ttl)
+
+    def generation(self, label):
+        key = self.key_prefix + "generation." + label
+        generation = self.cache.get(key)
+        if generation is None:
+            # The generation was never set, or was evicted. add keeps the token
+            # of a process that got here first.
+            token = uuid.uuid4().hex
+            self.cache.add(key, token, None)
+            generation = self.cache.get(key, token)
+        return generation
+
+    def changed(self, label):
+        return self.cache.get(self.key_prefix + "changed." + label)
+
+    def invalidate(self, label):
+        self.cache.set(self.key_prefix + "changed." + label, time.time(), None)
+        self.cache.set(self.key_prefix + "generation." + label,
+            uuid.uuid4().hex, None)
+
+def watch(model, backend):
+    """
+    Connects the post_save and post_delete signals of the model to the backend,
+    so that its counts are invalidated whenever an object changes.
+
+    """
+    label = model_label(model)
+    def invalidate(sender, **kwargs):
+        backend.invalidate(label)
+
+    uid = "djangocore.count_cache.%s.%d" % (label, id(backend))
+    post_save.connect(invalidate, sender=model, weak=False, dispatch_uid=uid)
+    post_delete.connect(invalidate, sender=model, weak=False, dispatch_uid=uid)
+
+class CountCache(object):
+    """
+    Caches the counts of a resource's query sets in a backend. The key of a
+    count is made of the resource, the generation of its model and the SQL of
+    the query, so any two requests that filter the same way share it.
+
+    """
+    def __init__(self, prefix, model, backend=None, ttl=60):
+        if backend is None:
+            backend = LocalCountCache()
+        self.prefix = prefix
+        self.label = model_label(model)
+        self.backend = backend
+        self.ttl = ttl
+        watch(model, backend)
+
+    def key(self, qs):
+        sql, params = qs.query.get_compiler(qs.db).as_sql()
+        query = "%s|%s|%s" % (qs.db, sql, repr(params))
+        return "%s%s.%s.%s" % (self.prefix, self.label,
+            self.backend.generation(self.label),
+            hashlib.sha1(query.encode("utf-8")).hexdigest())
+
+    def count(self, qs, counter=None):
+        """
+        Returns the cached count of the query set, or counts and caches it. The
+        counter function can return None to give up, which is not cached.
+
+        """
+        try:
+            key = self.key(qs)
+        except EmptyResultSet:
+            # i.e. an empty ANY set, which django counts without a query.
+            return qs.count()
+
+        count = self.backend.get(key)
+        if count is None:
+            if counter is None:
+                count = qs.count()
+            else:
+                count = counter(qs)
+            if count is not None:
+                self.backend.set(key, count, self.ttl)
+        return count
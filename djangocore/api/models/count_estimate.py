@@ -0,0 +1,124 @@
+"""
+Scrollers only need an idea of how many objects there are, and on huge tables
+an exact count takes far longer than a page. This module estimates counts
+from what the database already knows:
+
+- postgresql and mysql: the row estimate of the planner, from EXPLAIN
+- sqlite: a count over a random window of the primary keys, scaled up to the
+  whole key range
+
+and runs exact counts with a timeout, so that a resource can fall back to the
+estimate when the count takes too long.
+
+"""
+# Standard library dependencies.
+import re
+import time
+import random
+
+# Django dependencies.
+from django.db import connections, transaction, DatabaseError
+from django.db.models import Min, Max
+from django.db.models.sql.datastructures import EmptyResultSet
+
+class CountEstimator(object):
+    """
+    Estimates the number of objects in query sets. `estimate` returns a
+    (count, exact) tuple, since small tables are counted instead, or None
+    when the database can't estimate, in which case the caller has to count.
+
+    """
+    sample_size = 1000 # the number of primary keys in a sqlite sample
+
+    def __init__(self, sample_size=None):
+        if sample_size is not None:
+            self.sample_size = sample_size
+
+    def estimate(self, qs):
+        vendor = connections[qs.db].vendor
+        method = getattr(self, "estimate_%s" % vendor, None)
+        if method is None:
+            return None
+        try:
+            return method(qs)
+        except EmptyResultSet:
+            return 0, True
+
+    def explain(self, qs):
+        sql, params = qs.query.get_compiler(qs.db).as_sql()
+        cursor = connections[qs.db].cursor()
+        cursor.execute("EXPLAIN " + sql, params)
+        return cursor
+
+    def estimate_postgresql(self, qs):
+        # The first line of the plan holds the estimate for the whole query,
+        # i.e. "Seq Scan on polls_choice  (cost=0.00..1.06 rows=5 width=524)".
+        match = re.search(r"rows=(\d+)", self.explain(qs).fetchone()[0])
+        if match is None:
+            return None
+        return int(match.group(1)), False
+
+    def estimate_mysql(self, qs):
+        cursor = self.explain(qs)
+        columns = [c[0].lower() for c in cursor.description]
+        row = cursor.fetchone()
+        if row is None or "rows" not in columns:
+            return None
+        return int(row[columns.index("rows")] or 0), False
+
+    def estimate_sqlite(self, qs):
+        pk = qs.model._meta.pk
+        if pk.get_internal_type() not in ("AutoField", "IntegerField",
+            "BigIntegerField"):
+            return None
+        bounds = qs.model._default_manager.using(qs.db).aggregate(
+            low=Min(pk.name), high=Max(pk.name))
+        if bounds["low"] is None:
+            return 0, True
+        span = bounds["high"] - bounds["low"] + 1
+        if span <= self.sample_size:
+            # The whole table fits into a sample, so the count is cheap anyway.
+            return qs.count(), True
+
+        start = random.randint(bounds["low"],
+            bounds["high"] - self.sample_size + 1)
+        sample = qs.filter(pk__gte=start,
+            pk__lt=start + self.sample_size).count()
+        return int(round(sample * span / float(self.sample_size))), False
+
+def timed_count(qs, timeout):
+    """
+    Counts the query set, but gives up after `timeout` seconds and returns
+    None. Databases without a way to cancel a query are counted without one.
+
+    """
+    connection = connections[qs.db]
+    if connection.vendor == "sqlite":
+        connection.cursor() # Makes sure that there is a connection.
+        deadline = time.time() + timeout
+        connection.connection.set_progress_handler(
+            lambda: time.time() > deadline, 1000)
+        try:
+            try:
+                return qs.count()
+            except DatabaseError:
+                return None
+        finally:
+            connection.connection.set_progress_handler(None, 1000)
+
+    elif connection.vendor == "postgresql":
+        sid = transaction.savepoint(using=qs.db)
+        cursor = connection.cursor()
+        cursor.execute("SET LOCAL statement_timeout = %d"
+            % int(timeout * 1000))
+        try:
+            count = qs.count()
+        except DatabaseError:
+            # The canceled query aborted the transaction, up to the savepoint.
+            transaction.savepoint_rollback(sid, using=qs.db)
+            return None
+        cursor.execute("SET LOCAL statement_timeout TO DEFAULT")
+        transaction.savepoint_commit(sid, using=qs.db)
+        return count
+
+    return qs.count()
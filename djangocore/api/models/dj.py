@@ -1,33 +1,104 @@
 # Django dependencies.
-from django.core.exceptions import FieldError
-from django.db.models.query import QuerySet
+from django.core.exceptions import FieldError, ValidationError
+from django.db import connections
+from django.db.models.query import QuerySet, prefetch_related_objects
 from django.http import HttpResponse
 from django.forms.models import modelform_factory
 from django.shortcuts import get_object_or_404
 from django.db.models import Q
-from query_translator import translator
+from query_translator import translator, QueryError
+from query_cost import QueryCost
+from keyset import Keyset
+from relation_plan import RelationPlanner
+from row_serializer import RowSerializer
+from count_cache import CountCache, LocalCountCache, model_label, watch
+from count_estimate import CountEstimator, timed_count
 from djangocore.api import site
-
-import simplejson
+from djangocore.utils import LRUCache
 
 # Intra-app dependencies.
-from djangocore.api.models.base import BaseModelResource
-from djangocore.serialization import emitter, EmittableResponse
-
-from urllib import unquote_plus
+from djangocore.api.models.base import BaseModelResource, iterable
+from djangocore.serialization import emitter, EmittableResponse, \
+    StreamableResponse
+
+from itertools import islice
+import hashlib
+import time
+
+def supports_window_functions(using):
+    """
+    Returns whether the database supports window functions, i.e.
+    COUNT(*) OVER (). sqlite supports them since 3.25, mysql since 8.0.
+    
+    """
+    connection = connections[using]
+    if connection.vendor in ('postgresql', 'oracle'):
+        return True
+    if connection.vendor == 'sqlite':
+        import sqlite3
+        return sqlite3.sqlite_version_info >= (3, 25, 0)
+    return False
 
 class DjangoModelResource(BaseModelResource):
     allow_related_ordering = False # Allow ordering across relationships.
     user_field_name = None # The field to filter on the current user.
                            # Only logged in users get filtered responses.
 
+    query_cache_size = 256 # The number of compiled conditions to keep around.
+    cost_policy = None # A QueryCostPolicy that guards against expensive queries.
+    named_queries = {} # Maps names to NamedQuery objects clients can run.
+    in_chunk_size = 500 # The longest IN list of an ANY set, or of a bulk query.
+    window_count = True # Count list totals in the same query, where possible.
+    count_cache = None # The backend for cached counts, an in-process LRU by default.
+    count_cache_ttl = 60 # The seconds a count is cached, None for no expiry.
+    cache_counts = True # Cache the counts of length and list totals.
+    count_estimate = False # Estimate counts, as if clients sent ?estimate=1.
+    count_timeout = None # The seconds an exact count may take before length
+                         # falls back to the estimate, None for no timeout.
+    count_estimator = CountEstimator()
+    relation_cache_size = 64 # The number of compiled relations specs to keep.
+    stream_lists = False # Stream list responses, as if clients sent ?stream=1.
+    stream_batch_size = 100 # The number of objects serialized at a time.
+    max_ranges = 20 # The number of ranges a single ranges request may fetch.
+    range_gap = 100 # Ranges fewer objects apart are read with a single scan.
+    max_bulk_objects = 10000 # The number of pks a bulk request may ask for.
+    conditional_get = True # Answer If-None-Match and If-Modified-Since.
+    conditional_views = ('list', 'show', 'length', 'ranges') # The validated views.
+    row_serializers = True # Serialize objects with serializers compiled per
+                           # resource, instead of django's serializers.
+
     translator = None
     
     def __init__(self, *args, **kwargs):
         super(DjangoModelResource, self).__init__(*args, **kwargs)
 
-        """ create a translator object, so we have the regex' cached """
-        self.translator = translator()
+        """ create a translator object, so we have the regex' and the
+        compiled conditions cached """
+        self.translator = translator(self.model,
+            cache_size=self.query_cache_size, in_chunk_size=self.in_chunk_size)
+
+        # The backend counts the changes of the model by its signals. Counts
+        # are cached by these generations, and expire after count_cache_ttl
+        # seconds for changes that send no signals. Conditional requests are
+        # validated by them as well.
+        self.changes = self.count_cache or LocalCountCache()
+        watch(self.model, self.changes)
+        self.counts = None
+        if self.cache_counts:
+            self.counts = CountCache(self.get_url_prefix(), self.model,
+                backend=self.changes, ttl=self.count_cache_ttl)
+
+        # Compiled row serializers, by the fields they serialize.
+        self.serializers = LRUCache(32)
+
+        # Plans the queries for the related objects the clients ask for.
+        self.relation_planner = RelationPlanner(self.model,
+            cache_size=self.relation_cache_size)
+
+        # Compile the named queries once, so requests only bind parameters.
+        self.compiled_queries = {}
+        for name, query in self.named_queries.items():
+            self.compiled_queries[name] = (query, query.compile(self.translator))
 
         # Construct a default form if we don't have one already.
         if not self.form:
@@ -48,9 +119,57 @@ class DjangoModelResource(BaseModelResource):
         if isinstance(response, QuerySet):
             response = self.serialize_models(response, request)
         # TODO: how do we catch bad format requests?
-        format = request.GET.get('format', 'json')
-        response = emitter.translate(format, response)
-        return response
+        return super(DjangoModelResource, self).process_response(response,
+            request)
+
+    def get_row_serializer(self, fields=None):
+        """
+        Returns the compiled serializer for the fields. Models with exposed
+        methods need their instances to call them, so they have none.
+        
+        """
+        if not self.row_serializers or hasattr(self.model, 'exposedMethods'):
+            return None
+        key = fields
+        if fields is not None:
+            key = tuple(fields)
+        serializer = self.serializers.get(key)
+        if serializer is None:
+            serializer = RowSerializer(self.model, fields)
+            self.serializers.set(key, serializer)
+        return serializer
+
+    def get_validators(self, request, handler):
+        """
+        Validates the responses of the read-only views by the generation of
+        the model. The ETag hashes it with the request, and Last-Modified is
+        the time of the last change. Both advance at least every
+        count_cache_ttl seconds, which bounds how long changes without
+        signals (or, for the local backend, in other processes) go unnoticed.
+        
+        """
+        if not self.conditional_get or getattr(handler, '__name__', None) \
+            not in self.conditional_views:
+            return None, None
+
+        label = model_label(self.model)
+        last_modified = self.changes.changed(label)
+        period = 0
+        if self.count_cache_ttl:
+            period = int(time.time() // self.count_cache_ttl)
+            last_modified = max(last_modified or 0, period * self.count_cache_ttl)
+
+        user = None
+        if self.user_field_name:
+            user = getattr(request.user, 'pk', None)
+        etag = hashlib.sha1("|".join([str(v) for v in (
+            getattr(self.changes, 'token', ''), label,
+            self.changes.generation(label), period, user,
+            request.META.get('HTTP_ACCEPT', ''),
+            emitter.encoding_for_accept(
+                request.META.get('HTTP_ACCEPT_ENCODING')),
+            request.get_full_path())])).hexdigest()
+        return etag, last_modified
 
     def process_lookups(self, lookups):
         """
@@ -60,6 +179,65 @@ class DjangoModelResource(BaseModelResource):
         """
         return dict([(str(k), v) for k, v in lookups.items()])
 
+    def filter_query_set(self, qs, lookups):
+        """
+        Filters the query set by the conditions, or the lookups if there are
+        no conditions, after checking the query against the cost policy.
+        Returns the filtered query set and the QueryCost of the query.
+        
+        Raises a QueryError for malformed or rejected queries, and a
+        FieldError for bad lookups.
+        
+        """
+        # The output format is handled by process_response.
+        lookups.pop('format', None)
+        lookups.pop('pretty', None)
+        lookups.pop('layout', None)
+
+        name = iterable(lookups.pop('query', None))
+        if name:
+            # Named queries are declared by the server, so they don't need
+            # to pass the cost policy.
+            return self.apply_filter(qs, self.bind_named_query(name, lookups)), \
+                QueryCost()
+
+        plan, parameters = self.process_conditions(lookups)
+        lookups = self.process_lookups(lookups)
+
+        cost = QueryCost()
+        if self.cost_policy:
+            cost = self.cost_policy.evaluate(self, plan, lookups)
+
+        if plan is not None:
+            """ and now create a Q object from the query string """
+            qs = self.apply_filter(qs, self.translator.bind(plan, parameters))
+        else:
+            qs = self.apply_filter(qs, **lookups)
+        return cost.apply(qs), cost
+
+    def apply_filter(self, qs, *args, **kwargs):
+        """
+        Filters the query set, and raises a QueryError for values the fields
+        reject, which the translator couldn't coerce before.
+        
+        """
+        try:
+            return qs.filter(*args, **kwargs)
+        except (TypeError, ValueError, ValidationError), err:
+            raise QueryError("The conditions contain an invalid value: %s"
+                % err)
+
+    def bind_named_query(self, name, lookups):
+        """
+        Binds the remaining lookups as parameters into the named query and
+        returns its Q object. Raises a QueryError for unknown queries.
+        
+        """
+        if name not in self.compiled_queries:
+            raise QueryError("Unknown query '%s'" % name)
+        query, plan = self.compiled_queries[name]
+        return query.bind(self.translator, plan, dict(lookups.items()))
+
     def get_query_set(self, request):
         qs = self.model._default_manager.select_related().all()
 
@@ -70,78 +248,128 @@ class DjangoModelResource(BaseModelResource):
         return qs
 
     def length(self, request):
-        lookups = request.GET.copy()
-                        
-        def iterable(obj):
-            """django nowadays plants all vars in lists. 
-            i.e.
-            <QueryDict: {u'ordering': [u'name'], u'limit': [u'0'], u'conditions': [u'ipPublic = {ipp} AND ipUmts = {ipu}'], u'parameters': [u'ipp=192.168.1.1,ipu=frank,'], u'offset': [u'0']}>
-            Thus, this function detects lists and returns the first object, if possible
-            """
-            if hasattr(obj, '__getitem__'):
-                if len(obj)>0:
-                    return obj[0]
-                else:
-                    return obj
-            else:
-                return obj
+        lookups = self.get_lookups(request)
 
         qs = self.get_query_set(request)
 
         # just to remove the relations from the lookups array, TODO: rebuild this strange format
         relations = iterable(lookups.pop('relations', ""))
-                
-        conditions = iterable(lookups.pop('conditions', ""))
-        filter_q_object = None
-        if conditions!="" and conditions!=None and conditions!=0:
-
-            """ check if we have parameters """
-            parameters = iterable(lookups.pop('parameters', ""))
-            if parameters=="" or parameters==None:
-                parameters = {}
-            else:
-                """ the parameter format is 'ipp=192.168.1.1,ipu=frank,'
-                we need to create dicts from that."""
-                parameters = dict([x.split("=") for x in parameters.split(",") if x.strip()!=""])
-            
-            """parse the conditions """
-            conditionsString = unquote_plus(conditions);
 
-            """the format is a=b AND c=d OR """
-            """ and now create a Q object from the query string """
-            filter_q_object = self.translator.parse(conditionsString, parameters)
+        estimate = iterable(lookups.pop('estimate', '')) in ('1', 'true')
+                
         try:
             # Catch any lookup errors, and return the message, since they are
             # usually quite descriptive.
-            if filter_q_object != None:
-                qs = qs.filter(filter_q_object)
-            else:
-                qs = qs.filter(**self.process_lookups(lookups))
-        except FieldError, err:
+            qs, cost = self.filter_query_set(qs, lookups)
+        except (FieldError, QueryError), err:
             return EmittableResponse(str(err), status=400)
         
+        if cost.limit is None and \
+                not (estimate or self.count_estimate or self.count_timeout):
+            return self.count_query_set(qs, cost)
+
+        # Responses that may be estimated or truncated tell the client
+        # whether they are.
+        count, exact = self.estimate_query_set(qs, cost,
+            estimate or self.count_estimate)
+        return {'count': count, 'exact': exact}
+
+    def count_query_set(self, qs, cost, counter=None):
+        if cost.limit is not None:
+            # Expensive queries are only counted up to the capped limit.
+            qs = qs[:cost.limit]
+        if self.counts is not None:
+            return self.counts.count(qs, counter)
+        if counter is not None:
+            return counter(qs)
         return qs.count()
+
+    def estimate_query_set(self, qs, cost, estimate=True):
+        """
+        Returns a (count, exact) tuple. The count is estimated if requested,
+        or if the exact count takes longer than count_timeout seconds. Counts
+        are exact when the database can't estimate them, or when the
+        estimator counted instead, unless the cost policy truncated them.
+        
+        """
+        if not estimate:
+            counter = None
+            if self.count_timeout:
+                counter = lambda qs: timed_count(qs, self.count_timeout)
+            count = self.count_query_set(qs, cost, counter)
+            if count is not None:
+                return count, self.is_complete_count(count, cost)
+
+        estimate = self.count_estimator.estimate(qs)
+        if estimate is None:
+            count = self.count_query_set(qs, cost)
+            return count, self.is_complete_count(count, cost)
+        count, exact = estimate
+        if exact:
+            return count, True
+        return cost.cap(count), False
+
+    def is_complete_count(self, count, cost):
+        """
+        Returns whether a count from count_query_set is exact, which it isn't
+        if it reached the limit the cost policy truncated the query set to.
+        
+        """
+        return cost.limit is None or count < cost.limit
     
     def fileupload(self, request):
         print request
 
     def list(self, request):
-        lookups = request.GET.copy()
-        
-        def iterable(obj):
-            """django nowadays plants all vars in lists. 
-            i.e.
-            <QueryDict: {u'ordering': [u'name'], u'limit': [u'0'], u'conditions': [u'ipPublic = {ipp} AND ipUmts = {ipu}'], u'parameters': [u'ipp=192.168.1.1,ipu=frank,'], u'offset': [u'0']}>
-            Thus, this function detects lists and returns the first object, if possible
-            """
-            if hasattr(obj, '__getitem__'):
-                if len(obj)>0:
-                    return obj[0]
-                else:
-                    return obj
-            else:
-                return obj
+        lookups = self.get_lookups(request)
+
+        # Clients that send a cursor (an empty one for the first page) get
+        # the page after it, instead of paging by offset.
+        cursor = iterable(lookups.pop('cursor', None))
+        # Clients that need the total as well get it with the page, so they
+        # don't have to send the same conditions to length.
+        with_total = iterable(lookups.pop('with_total', '')) in ('1', 'true')
+        # Streamed lists are serialized and sent while the rows are read.
+        stream = iterable(lookups.pop('stream', '')) in ('1', 'true') \
+            or self.stream_lists
+
+        offset = int(iterable(lookups.pop('offset', 0)))
+        limit = min(int(iterable(lookups.pop('limit', self.max_objects))), int(iterable(self.max_objects)))
+                
+        try:
+            # Catch any lookup errors, and return the message, since they are
+            # usually quite descriptive.
+            qs, ordering, fields, cost = self.list_query_set(request, lookups)
+        except (FieldError, QueryError), err:
+            return EmittableResponse(str(err), status=400)
+
+        limit = cost.cap(limit)
+        if cursor is not None:
+            page = self.list_page(request, qs, ordering, cursor, limit, fields)
+            if with_total and isinstance(page, dict):
+                page['total'] = self.count_query_set(qs, cost)
+            return page
+        if with_total:
+            return self.list_with_total(request, qs, offset, limit, cost, fields)
+        if fields is not None:
+            qs = self.project_query_set(qs, fields)
+        if stream:
+            return StreamableResponse(self.stream_models(
+                qs[offset:offset + limit], request, fields))
+        if fields is not None:
+            return self.serialize_models(qs[offset:offset + limit], request,
+                fields)
+        return qs[offset:offset + limit]
+
+    def list_query_set(self, request, lookups):
+        """
+        Orders and filters the query set of a list request, and plans the
+        queries for its relations. Returns a (query set, ordering, fields,
+        cost) tuple, where fields are the projected fields or None.
         
+        Raises a QueryError or a FieldError for bad requests.
+        
+        """
         qs = self.get_query_set(request)
 
         # just to remove the relations from the lookups array, TODO: rebuild this strange format
@@ -150,50 +378,245 @@ class DjangoModelResource(BaseModelResource):
         ordering = iterable(lookups.pop('ordering', None))
         if ordering:
             if not self.allow_related_ordering and '__' in ordering:
-                return EmittableResponse("This model cannot be ordered by "
+                raise QueryError("This model cannot be ordered by "
                     "related objects. Please remove all ocurrences of '__' from"
-                    " your ordering parameters.", status=400)
+                    " your ordering parameters.")
             ordering = ordering.split(',')            
             if len(ordering) > self.max_orderings:
-                return EmittableResponse("This model cannot be ordered by more "
+                raise QueryError("This model cannot be ordered by more "
                     "than %d parameter(s). You tried to order by %d parameters."
-                    % (self.max_orderings, len(ordering)), status=400)
+                    % (self.max_orderings, len(ordering)))
             qs = qs.order_by(*ordering)
+        else:
+            ordering = self.model._meta.ordering
 
-        offset = int(iterable(lookups.pop('offset', 0)))
-        limit = min(int(iterable(lookups.pop('limit', self.max_objects))), int(iterable(self.max_objects)))
-                
-        filter_q_object = None
-        """ check if we have conditions and request parameters """
-        conditions = iterable(lookups.pop('conditions', ""))
-        if conditions!="" and conditions!=None and conditions!=0:
-
-            """ check if we have parameters """
-            parameters = iterable(lookups.pop('parameters', ""))
-            if parameters=="" or parameters==None:
-                parameters = {}
-            else:
-                """ the parameter format is 'ipp=192.168.1.1,ipu=frank,'
-                we need to create dicts from that."""
-                parameters = dict([x.split("=") for x in parameters.split(",") if x.strip()!=""])
-            
-            """parse the conditions """
-            conditionsString = unquote_plus(conditions);
+        fields = self.get_projection(lookups)
+        qs = self.plan_relations(qs, relations, fields)
+
+        qs, cost = self.filter_query_set(qs, lookups)
+        return qs, ordering, fields, cost
+
+    def ranges(self, request):
+        """
+        Returns several (offset, limit) ranges of one list query, i.e. the
+        index ranges a SC.SparseArray requests while the user scrolls:
+        ?ranges=0:50,500:50. Ranges that are close together are read with a
+        single scan. Responds with {ranges: [{offset, records}, ...]}, and the
+        total if with_total=1 is given.
+        
+        """
+        lookups = self.get_lookups(request)
+        with_total = iterable(lookups.pop('with_total', '')) in ('1', 'true')
 
-            """the format is a=b AND c=d OR """
-            """ and now create a Q object from the query string """
-            filter_q_object = self.translator.parse(conditionsString, parameters)
         try:
-            # Catch any lookup errors, and return the message, since they are
-            # usually quite descriptive.
-            if filter_q_object:
-                qs = qs.filter(filter_q_object)
+            ranges = self.get_ranges(lookups)
+            qs, ordering, fields, cost = self.list_query_set(request, lookups)
+        except (FieldError, QueryError), err:
+            return EmittableResponse(str(err), status=400)
+
+        if fields is not None:
+            qs = self.project_query_set(qs, fields)
+
+        response = {'ranges': []}
+        for start, end, members in self.merge_ranges(ranges, cost):
+            objects = list(qs[start:end])
+            for offset, limit in members:
+                response['ranges'].append({
+                    'offset': offset,
+                    'records': self.serialize_models(
+                        objects[offset - start:offset - start + limit],
+                        request, fields),
+                })
+        if with_total:
+            response['total'] = self.count_query_set(qs, cost)
+        return response
+
+    def get_ranges(self, lookups):
+        """
+        Pops the `ranges` parameter, either "offset:limit,offset:limit" or a
+        list of [offset, limit] pairs in a JSON request body, and returns the
+        (offset, limit) tuples. Raises a QueryError for malformed ranges.
+        
+        """
+        ranges = iterable(lookups.pop('ranges', None))
+        if isinstance(ranges, basestring):
+            ranges = [r.split(':') for r in ranges.split(',') if r.strip()]
+        if not ranges:
+            raise QueryError("The request must specify a ranges argument")
+        if len(ranges) > self.max_ranges:
+            raise QueryError("A request can only fetch %d ranges, not %d"
+                % (self.max_ranges, len(ranges)))
+
+        result = []
+        for r in ranges:
+            try:
+                offset, limit = [int(i) for i in r]
+            except (TypeError, ValueError):
+                raise QueryError("The range %r is not an offset:limit pair"
+                    % (r,))
+            if offset < 0 or limit < 0:
+                raise QueryError("The range %d:%d is negative" % (offset, limit))
+            result.append((offset, min(limit, self.max_objects)))
+        return result
+
+    def merge_ranges(self, ranges, cost):
+        """
+        Sorts the ranges and merges those that overlap or are less than
+        range_gap objects apart into spans. Returns a list of (start, end,
+        ranges) tuples, one for every span.
+        
+        """
+        spans = []
+        for offset, limit in sorted(ranges):
+            limit = cost.cap(limit)
+            if spans and offset <= spans[-1][1] + self.range_gap:
+                start, end, members = spans[-1]
+                spans[-1] = (start, max(end, offset + limit), members)
             else:
-                qs = qs.filter(**self.process_lookups(lookups))
-        except FieldError, err:
+                spans.append((offset, offset + limit, []))
+            spans[-1][2].append((offset, limit))
+        return spans
+
+    def stream_models(self, qs, request, fields=None):
+        """
+        Yields the serialized objects of the query set. The rows are read
+        with iterator(), and serialized in batches of stream_batch_size
+        objects, so only one batch is held in memory at a time.
+        
+        """
+        options = self.get_options(request)
+        serializer = None
+        if not options.get('relations'):
+            if fields is None:
+                fields = self.fields or None
+            serializer = self.get_row_serializer(fields)
+        if serializer is not None:
+            # Plain rows are enough, so no model instances are created.
+            rows = serializer.rows(qs).iterator()
+            columns = options.get('layout') == 'columns'
+            if columns:
+                yield serializer.header()
+            while True:
+                batch = list(islice(rows, self.stream_batch_size))
+                if not batch:
+                    break
+                if columns:
+                    batch = serializer.serialize_columns(batch, header=False)
+                else:
+                    batch = serializer.serialize_rows(batch)
+                for record in batch:
+                    yield record
+            return
+
+        lookups = qs._prefetch_related_lookups
+        objects = qs.iterator()
+        while True:
+            batch = list(islice(objects, self.stream_batch_size))
+            if not batch:
+                break
+            if lookups:
+                # iterator() skips prefetch_related, so every batch
+                # prefetches its own related objects.
+                prefetch_related_objects(batch, lookups)
+            for record in self.serialize_models(batch, request, fields):
+                yield record
+
+    def get_projection(self, lookups):
+        """
+        Pops the `fields` parameter, a comma separated list of field names,
+        and returns the names, or None if all fields were requested. The key
+        is always sent, so `fields=pk` projects to an empty list. Raises a
+        QueryError for fields the resource doesn't expose.
+        
+        """
+        fields = iterable(lookups.pop('fields', None))
+        if not fields:
+            return None
+        fields = [str(f.strip()) for f in fields.split(',')
+            if f.strip() and f.strip() != 'pk']
+
+        opts = self.model._meta
+        allowed = self.fields or [f.name for f in opts.fields + opts.many_to_many]
+        unknown = [f for f in fields if f not in allowed]
+        if unknown:
+            raise QueryError("This model has no fields named %s"
+                % ", ".join(unknown))
+        return fields
+
+    def plan_relations(self, qs, relations, fields=None):
+        """
+        Fetches the related objects the serializer will include with a
+        bounded number of queries. Projected fields are serialized without
+        their relations, so they don't need any.
+        
+        """
+        if not relations or fields is not None:
+            return qs
+        return self.relation_planner.plan(relations).apply(qs)
+
+    def project_query_set(self, qs, fields):
+        """
+        Loads only the columns of the requested fields. Related objects are
+        serialized as their keys, so the joins of select_related are dropped.
+        
+        """
+        opts = self.model._meta
+        columns = [opts.pk.name] + [f.name for f in opts.fields
+            if f.name in fields]
+        qs = qs.only(*columns)
+        qs.query.select_related = False
+        return qs
+
+    def list_with_total(self, request, qs, offset, limit, cost, fields=None):
+        """
+        Returns the page of objects and the total number of objects. Where the
+        database supports it, the total is counted by a window function in
+        the query of the page.
+        
+        """
+        total = None
+        page = qs
+        if fields is not None:
+            page = self.project_query_set(qs, fields)
+        if self.window_count and supports_window_functions(qs.db):
+            objects = list(page.extra(select={'_total': 'COUNT(*) OVER ()'})
+                [offset:offset + limit])
+            if objects:
+                total = objects[0]._total
+                if cost.limit is not None:
+                    total = min(total, cost.limit)
+        else:
+            objects = list(page[offset:offset + limit])
+
+        if total is None:
+            # The page is past the last object, or the database can't count
+            # with a window function.
+            total = self.count_query_set(qs, cost)
+
+        return {
+            'records': self.serialize_models(objects, request, fields),
+            'total': total,
+        }
+
+    def list_page(self, request, qs, ordering, cursor, limit, fields=None):
+        """
+        Returns the page of objects after the cursor, with the cursor of the
+        next page and whether there are more objects after it.
+        
+        """
+        if fields is not None:
+            qs = self.project_query_set(qs, fields)
+        try:
+            objects, cursor, has_more = Keyset(self.translator,
+                ordering).page(qs, cursor, limit)
+        except (FieldError, QueryError), err:
             return EmittableResponse(str(err), status=400)
 
-        return qs[offset:offset + limit]
+        return {
+            'records': self.serialize_models(objects, request, fields),
+            'cursor': cursor,
+            'has_more': has_more,
+        }
 
     def show(self, request):
         pk_list = request.GET.getlist('pk')
@@ -202,8 +625,83 @@ class DjangoModelResource(BaseModelResource):
             return EmittableResponse("The request must specify a pk argument",
                 status=400)
                     
+        qs = self.get_query_set(request).filter(pk__in=pk_list)
+        try:
+            fields = self.get_projection(request.GET.copy())
+            qs = self.plan_relations(qs, request.GET.get('relations'), fields)
+        except QueryError, err:
+            return EmittableResponse(str(err), status=400)
+
+        if fields is not None:
+            return self.serialize_models(self.project_query_set(qs, fields),
+                request, fields)
+        return qs
+
+    def bulk_show(self, request):
+        """
+        Like show, but for large selections. The pks are POSTed, as a JSON
+        object {"pks": [...]} or as form-encoded pk values, and fetched in
+        chunks of in_chunk_size. Responds with {records, missing}, where the
+        records are in the requested order and missing lists the pks that
+        don't exist, or that the user can't see.
+        
+        """
+        data = request.data
+        if hasattr(data, 'getlist'):
+            pk_list = data.getlist('pk')
+        elif isinstance(data, dict):
+            pk_list = data.get('pks')
+        else:
+            pk_list = None
+
+        if not isinstance(pk_list, (list, tuple)) or len(pk_list) == 0:
+            return EmittableResponse("The request must specify a list of pks",
+                status=400)
+        if len(pk_list) > self.max_bulk_objects:
+            return EmittableResponse("A request can only fetch %d objects, "
+                "not %d" % (self.max_bulk_objects, len(pk_list)), status=400)
+
+        lookups = self.get_lookups(request)
         qs = self.get_query_set(request)
-        return qs.filter(pk__in=pk_list)    
+        try:
+            pk_list = self.coerce_pks(pk_list)
+            fields = self.get_projection(lookups)
+            qs = self.plan_relations(qs, iterable(lookups.get('relations')),
+                fields)
+        except QueryError, err:
+            return EmittableResponse(str(err), status=400)
+        if fields is not None:
+            qs = self.project_query_set(qs, fields)
+
+        found = {}
+        for i in range(0, len(pk_list), self.in_chunk_size):
+            for obj in qs.filter(pk__in=pk_list[i:i + self.in_chunk_size]):
+                found[obj.pk] = obj
+
+        return {
+            'records': self.serialize_models(
+                [found[pk] for pk in pk_list if pk in found], request, fields),
+            'missing': [pk for pk in pk_list if pk not in found],
+        }
+
+    def coerce_pks(self, pk_list):
+        """
+        Converts the pks to the type of the primary key, and drops
+        duplicates. Raises a QueryError for invalid pks.
+        
+        """
+        coercer = self.translator.coercer_for('pk')
+        result = []
+        seen = set()
+        for pk in pk_list:
+            try:
+                pk = coercer(pk)
+            except (ValidationError, TypeError, ValueError):
+                raise QueryError("The value %r is not a valid pk" % (pk,))
+            if pk not in seen:
+                seen.add(pk)
+                result.append(pk)
+        return result
 
     def create(self, request):
         data = request.data
@@ -0,0 +1,157 @@
+"""
+Keyset pagination pages through a query set by its ordering instead of by an
+offset. The cursor of a page holds the ordering values of its last object,
+and the next page starts right after them, i.e. for ?ordering=-votes:
+
+    WHERE votes < 3 OR (votes = 3 AND id > 17) ORDER BY votes DESC, id ASC
+
+so the database can seek to the page with an index, however deep it is. The
+primary key is appended to every ordering, so that objects with equal values
+still have a well defined order.
+
+"""
+# Standard library dependencies.
+import base64
+
+# Django dependencies.
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Model, Q
+from django.db.models.fields import FieldDoesNotExist
+from django.utils import simplejson
+
+# Intra-app dependencies.
+from query_translator import QueryError
+
+class CursorError(QueryError):
+    """Raised for cursors that are malformed or were made for another
+    ordering."""
+    pass
+
+class Keyset(object):
+    """
+    Pages through query sets with the given ordering. The translator of the
+    resource converts the cursor values back to the types of their fields.
+
+    """
+    def __init__(self, translator, ordering):
+        ordering = [str(o) for o in ordering if o]
+        if "?" in ordering:
+            raise QueryError("Randomly ordered queries can't be paged with a "
+                "cursor")
+        if "pk" not in [o.lstrip("-") for o in ordering]:
+            ordering.append("pk")
+        self.ordering = ordering
+        self.translator = translator
+
+    def page(self, qs, cursor, limit):
+        """
+        Returns the objects of the page after the cursor (the first page if
+        the cursor is empty), the cursor of the next page, and whether there
+        are more objects. One more object than the limit is fetched to find
+        out if there are.
+
+        """
+        if cursor:
+            qs = qs.filter(self.seek(qs.db, self.decode(cursor)))
+        objects = list(qs.order_by(*self.ordering)[:limit + 1])
+        has_more = len(objects) > limit
+        objects = objects[:limit]
+        if objects:
+            cursor = self.encode(objects[-1])
+        return objects, cursor or None, has_more
+
+    def value(self, obj, name):
+        parts = name.split("__")
+        for i, part in enumerate(parts):
+            if i == len(parts) - 1 and isinstance(obj, Model):
+                try:
+                    field = obj._meta.get_field(part)
+                except FieldDoesNotExist:
+                    field = None
+                if field is not None and field.rel:
+                    # The key is on the object, while the related object
+                    # would have to be loaded with another query.
+                    return getattr(obj, field.attname)
+            obj = getattr(obj, part)
+            if obj is None:
+                break
+        if isinstance(obj, Model):
+            return obj.pk
+        return obj
+
+    def encode(self, obj):
+        """Returns the cursor that points right after the given object."""
+        values = [self.value(obj, o.lstrip("-")) for o in self.ordering]
+        data = simplejson.dumps([",".join(self.ordering), values],
+            cls=DjangoJSONEncoder)
+        return base64.urlsafe_b64encode(data).rstrip("=")
+
+    def decode(self, cursor):
+        """
+        Returns the ordering values that are stored in a cursor, converted to
+        the types of their fields. Raises a CursorError for invalid cursors.
+
+        """
+        try:
+            cursor = str(cursor)
+            data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            ordering, values = simplejson.loads(data)
+        except (TypeError, ValueError, UnicodeError):
+            raise CursorError("The cursor %r is not valid" % cursor)
+        if ordering != ",".join(self.ordering) or \
+            len(values) != len(self.ordering):
+            raise CursorError("The cursor was made for another ordering")
+
+        for i, order in enumerate(self.ordering):
+            coercer = self.translator.coercer_for(
+                order.lstrip("-").replace("__", "."))
+            if coercer is not None and values[i] is not None:
+                try:
+                    values[i] = coercer(values[i])
+                except (ValidationError, TypeError, ValueError):
+                    raise CursorError("The cursor %r is not valid" % cursor)
+        return values
+
+    def seek(self, using, values):
+        """
+        Returns a Q object that matches the objects after the given ordering
+        values. The database decides where NULLs go: sqlite and mysql sort them
+        first in ascending orders, postgresql and oracle sort them last.
+
+        """
+        nulls_first = connections[using].vendor in ("sqlite", "mysql")
+        result = None
+        equal = Q()
+        for order, value in zip(self.ordering, values):
+            name = order.lstrip("-")
+            descending = order.startswith("-")
+            nulls_last = descending == nulls_first
+
+            if value is None:
+                after = None
+                if not nulls_last:
+                    after = Q(**{"%s__isnull" % name: False})
+            else:
+                lookup = descending and "lt" or "gt"
+                after = Q(**{"%s__%s" % (name, lookup): value})
+                if nulls_last:
+                    after = after | Q(**{"%s__isnull" % name: True})
+
+            if after is not None:
+                after = equal & after
+                if result is None:
+                    result = after
+                else:
+                    result = result | after
+
+            if value is None:
+                equal = equal & Q(**{"%s__isnull" % name: True})
+            else:
+                equal = equal & Q(**{name: value})
+
+        if result is None:
+            # Nothing sorts after the last object.
+            return Q(pk__in=[])
+        return result
@@ -0,0 +1,90 @@
+"""
+Named queries are declared by the server, so the client only has to send the
+name of the query and its parameters, i.e. ?query=by_poll&poll=1. Their
+conditions are compiled once, when the resource is created, and the
+parameters are checked against the declared ones before anything is bound.
+
+"""
+# Intra-app dependencies.
+from query_translator import QueryError, Comparison, Not, Parameter
+
+class NamedQuery(object):
+    """
+    A query that clients can run by name. The query is either a condition
+    string, or a function that takes the parameters as keyword arguments and
+    returns a Q object. The keyword arguments map the parameter names to a
+    function that converts the parameter value, or None to leave it to the
+    translator's field coercion:
+
+        named_queries = {
+            'by_poll': NamedQuery("poll = {poll} AND votes >= {min}",
+                poll=None, min=int),
+            'popular': NamedQuery(lambda min: Q(votes__gte=min), min=int),
+        }
+
+    """
+    def __init__(self, query, **parameters):
+        self.query = query
+        self.parameters = parameters
+
+    def compile(self, translator):
+        """
+        Compiles the conditions with the translator of the resource. Returns
+        the plan, or None for query functions.
+
+        """
+        if callable(self.query):
+            return None
+
+        plan = translator.compile(self.query)
+        undeclared = [name for name in parameter_names(plan)
+            if name not in self.parameters]
+        if undeclared:
+            raise TypeError("The query %r uses the undeclared parameters %s"
+                % (self.query, ", ".join(undeclared)))
+        return plan
+
+    def bind(self, translator, plan, values):
+        """
+        Checks and converts the request values and returns the Q object of the
+        query. Raises a QueryError for unknown, missing or invalid parameters.
+
+        """
+        unknown = [name for name in values if name not in self.parameters]
+        if unknown:
+            raise QueryError("Unknown query parameters: %s"
+                % ", ".join(sorted(unknown)))
+        missing = [name for name in self.parameters if name not in values]
+        if missing:
+            raise QueryError("Missing query parameters: %s"
+                % ", ".join(sorted(missing)))
+
+        parameters = {}
+        for name, convert in self.parameters.items():
+            value = values[name]
+            if convert is not None:
+                try:
+                    value = convert(value)
+                except (TypeError, ValueError):
+                    raise QueryError("The value %r is not valid for the "
+                        "parameter '%s'" % (value, name))
+            parameters[str(name)] = value
+
+        if plan is None:
+            return self.query(**parameters)
+        return translator.bind(plan, parameters)
+
+def parameter_names(node):
+    """Returns the names of all parameters in a syntax tree."""
+    names = []
+    if node is None:
+        return names
+    if isinstance(node, Comparison):
+        values = isinstance(node.value, list) and node.value or [node.value]
+        names.extend([v.name for v in values if isinstance(v, Parameter)])
+    elif isinstance(node, Not):
+        names.extend(parameter_names(node.child))
+    else:
+        for child in node.children:
+            names.extend(parameter_names(child))
+    return names
@@ -0,0 +1,213 @@
+"""
+This module offers a cost policy that looks at a parsed query (or at the
+lookups sent by the client) before it is executed, and decides whether the
+query may run as it is, whether its limit has to be capped, whether it should
+be routed to another database, or whether it has to be rejected.
+
+Every decision is logged to the 'djangocore.api.cost' logger, so a policy can
+be tuned from the logs of real traffic.
+
+"""
+# Standard library dependencies.
+import logging
+
+# Django dependencies.
+from django.db.models.fields import FieldDoesNotExist
+
+# Intra-app dependencies.
+from query_translator import QueryError, Comparison, Not
+
+logger = logging.getLogger('djangocore.api.cost')
+
+ALLOW = 'allow'
+LIMIT = 'limit'
+ROUTE = 'route'
+REJECT = 'reject'
+
+class QueryCostError(QueryError):
+    """Raised when a query is rejected by the cost policy."""
+    pass
+
+class QueryCost(object):
+    """
+    The cost of one query, as computed by QueryCostPolicy.inspect, and the
+    action the policy decided on.
+
+    """
+    def __init__(self):
+        self.joins = set() # the relations the query follows
+        self.regex = 0 # the number of regular expression comparisons
+        self.unanchored = 0 # the number of CONTAINS and ENDS_WITH comparisons
+        self.unindexed = [] # the fields that are compared without an index
+        self.reasons = []
+        self.action = ALLOW
+        self.limit = None
+        self.using = None
+
+    def cap(self, limit):
+        """Returns the given limit, capped by the policy if required."""
+        if self.limit is not None:
+            return min(limit, self.limit)
+        return limit
+
+    def apply(self, qs):
+        """Routes the query set to another database if required."""
+        if self.using is not None:
+            return qs.using(self.using)
+        return qs
+
+    def __str__(self):
+        return "The query is too expensive: %s." % "; ".join(self.reasons)
+
+class QueryCostPolicy(object):
+    """
+    A per-resource policy. Options can be given as keyword arguments, or by
+    subclassing, i.e.:
+
+        site.register(ModelResource, model=Poll,
+            cost_policy=QueryCostPolicy(allow_regex=False, action='limit',
+                limit=20))
+
+    """
+    max_joins = None # the number of relations a query may follow, None for any
+    allow_regex = True # allow MATCHES and regex lookups
+    allow_unanchored = True # allow CONTAINS, ICONTAINS and ENDS_WITH
+    allow_unindexed = True # allow comparisons on fields without an index
+
+    action = REJECT # 'reject', 'limit' or 'route' expensive queries
+    limit = 50 # the maximum number of objects for the 'limit' action
+    using = None # the database alias for the 'route' action
+
+    # Lookups and operators, grouped by how the database evaluates them.
+    regex_lookups = ('regex', 'iregex', 'MATCHES')
+    unanchored_lookups = ('contains', 'icontains', 'endswith', 'iendswith',
+        'CONTAINS', 'ICONTAINS', 'ENDS_WITH')
+
+    def __init__(self, **options):
+        for name, value in options.items():
+            if not hasattr(self, name):
+                raise TypeError("%s has no option '%s'"
+                    % (self.__class__.__name__, name))
+            setattr(self, name, value)
+
+        if self.action not in (REJECT, LIMIT, ROUTE):
+            raise TypeError("Unknown cost policy action '%s'" % self.action)
+
+    def evaluate(self, resource, plan=None, lookups={}):
+        """
+        Inspects the query, decides on an action and logs the decision.
+        Returns a QueryCost, or raises a QueryCostError if the query is
+        rejected.
+
+        """
+        cost = self.inspect(resource.model, plan, lookups)
+        self.decide(cost)
+
+        logger.info("%s: %s (joins=%d, regex=%d, unanchored=%d, "
+            "unindexed=%s) %s", resource.__class__.__name__, cost.action,
+            len(cost.joins), cost.regex, cost.unanchored,
+            ",".join(cost.unindexed) or "-", "; ".join(cost.reasons))
+
+        if cost.action == REJECT:
+            raise QueryCostError(str(cost))
+        return cost
+
+    def inspect(self, model, plan=None, lookups={}):
+        """
+        Computes the cost of a parsed query (if given) or of django lookups.
+
+        """
+        cost = QueryCost()
+        if plan is not None:
+            for comparison in self.comparisons(plan):
+                # The translator compiles "poll__question" to the same join
+                # as "poll.question".
+                parts = comparison.field.replace('__', '.').split('.')
+                self.add(cost, model, parts, comparison.operator)
+        else:
+            for key in lookups:
+                parts = str(key).split('__')
+                self.add(cost, model, parts, None)
+        return cost
+
+    def comparisons(self, node):
+        if isinstance(node, Comparison):
+            yield node
+        elif isinstance(node, Not):
+            for comparison in self.comparisons(node.child):
+                yield comparison
+        else:
+            for child in node.children:
+                for comparison in self.comparisons(child):
+                    yield comparison
+
+    def add(self, cost, model, parts, operator):
+        """
+        Adds one comparison to the cost. Follows the field path through the
+        model's relations; whatever is left of the path is the lookup type.
+
+        """
+        field = None
+        path = []
+        for i, part in enumerate(parts):
+            if part == 'pk':
+                field = model._meta.pk
+            else:
+                try:
+                    field = model._meta.get_field_by_name(part)[0]
+                except FieldDoesNotExist:
+                    # The rest of the path is a lookup type, i.e. 'startswith'.
+                    if operator is None:
+                        operator = part
+                    break
+            path.append(part)
+
+            related = self.related_model(field)
+            if related is not None and i < len(parts) - 1:
+                cost.joins.add('.'.join(path))
+                model = related
+
+        if operator in self.regex_lookups:
+            cost.regex += 1
+        elif operator in self.unanchored_lookups:
+            cost.unanchored += 1
+
+        if field is not None and not self.is_indexed(field):
+            cost.unindexed.append('.'.join(path))
+
+    def related_model(self, field):
+        if getattr(field, 'rel', None) is not None:
+            return field.rel.to
+        if hasattr(field, 'get_accessor_name'):
+            # A reverse relation, i.e. 'choice' on a Poll.
+            return field.model
+        return None
+
+    def is_indexed(self, field):
+        if not hasattr(field, 'db_index'):
+            # Reverse relations are looked up by the foreign key on the other
+            # side, which django indexes by default.
+            return getattr(field.field, 'db_index', True)
+        return field.db_index or field.unique or field.primary_key
+
+    def decide(self, cost):
+        if self.max_joins is not None and len(cost.joins) > self.max_joins:
+            cost.reasons.append("it follows %d relations, only %d are allowed"
+                % (len(cost.joins), self.max_joins))
+        if cost.regex and not self.allow_regex:
+            cost.reasons.append("regular expressions are not allowed")
+        if cost.unanchored and not self.allow_unanchored:
+            cost.reasons.append("CONTAINS and ENDS_WITH comparisons are not "
+                "allowed")
+        if cost.unindexed and not self.allow_unindexed:
+            cost.reasons.append("the fields %s are not indexed"
+                % ", ".join(cost.unindexed))
+
+        if not cost.reasons:
+            return
+
+        cost.action = self.action
+        if self.action == LIMIT:
+            cost.limit = self.limit
+        elif self.action == ROUTE:
+            cost.using = self.using
@@ -1,5 +1,8 @@
 import re
-from django.db.models import Q
+from django.core.exceptions import ValidationError
+from django.db.models import Q, F, BooleanField, NullBooleanField
+
+from djangocore.utils import LRUCache
 
 """
   This module offers a translator object that takes simple sproutcore queries and
@@ -12,42 +15,342 @@ from django.db.models import Q
   - CocoPy
 
   But these are a bit of an overload for an engine that has to parse all client queries
-  that come into the server. Also, the sproutcore sql syntax is rather limited and simple 
+  that come into the server. Also, the sproutcore sql syntax is rather limited and simple
   too which makes it not too difficult to implement a library for it.
-  Finally, using these libraries would only result in a parsed token-tree that still has to be 
+  Finally, using these libraries would only result in a parsed token-tree that still has to be
   evaluated into a django tree.
-  Given that, I deemed it easier to write a simple parser & tokenizer based on a couple of regular expressions
-  to achieve something close to a full recursive descent parser.
+
+  The translator works in three steps:
+  - a tokenizer that walks the query exactly once, using a single regular expression
+    without nested quantifiers, so it can't backtrack
+  - a recursive descent parser that turns the tokens into a small syntax tree
+    (Or, And, Not, Comparison), with NOT binding tighter than AND, and AND binding
+    tighter than OR. Parenthesis can be used for grouping.
+  - a compiler that turns the syntax tree and the request parameters into a Q object,
+    or, for the AppEngine datastore, into a list of filters (see datastore_compiler)
+
+  The syntax tree doesn't depend on the request parameters or the backend, so it is
+  cached per query.
+
+  If the translator knows the model that is queried, every value is coerced to the
+  python type of the field it is compared against (literals when the query is parsed,
+  parameters when they are bound), so the database never has to cast them.
 """
 
-c_and = "and"
-c_or = "or"
-c_not = "not"
+class QueryError(ValueError):
+  """Raised when a query can't be parsed or compiled."""
+  pass
+
+"""
+  The nodes of the syntax tree. Values on the right hand side of a comparison
+  are either a Literal, a Parameter, a FieldReference or a list of those.
+"""
+class Literal(object):
+  def __init__(self, value):
+    self.value = value
+
+  def __repr__(self):
+    return "Literal(%r)" % (self.value,)
+
+class Parameter(object):
+  def __init__(self, name):
+    self.name = name
+
+  def __repr__(self):
+    return "Parameter(%r)" % (self.name,)
+
+class FieldReference(object):
+  def __init__(self, name):
+    self.name = name
+
+  def __repr__(self):
+    return "FieldReference(%r)" % (self.name,)
+
+class Comparison(object):
+  def __init__(self, field, operator, value, negated=False):
+    self.field = field
+    self.operator = operator
+    self.value = value
+    self.negated = negated
+
+  def __repr__(self):
+    return "Comparison(%r, %r, %r, negated=%r)" % (self.field, self.operator,
+      self.value, self.negated)
+
+class Not(object):
+  def __init__(self, child):
+    self.child = child
+
+  def __repr__(self):
+    return "Not(%r)" % (self.child,)
+
+class And(object):
+  def __init__(self, children):
+    self.children = children
+
+  def __repr__(self):
+    return "And(%r)" % (self.children,)
 
-class logic_expression(object):
+class Or(object):
+  def __init__(self, children):
+    self.children = children
+
+  def __repr__(self):
+    return "Or(%r)" % (self.children,)
+
+
+class tokenizer(object):
   """
-    A small helper entity that keeps track of a current expression
+    Splits a query into (type, value, position) tuples. Every alternative in
+    the expression below consumes input without nested repetition, so a query
+    is tokenized in a single linear pass.
   """
-  has_and = False
-  has_or = False
-  has_not = False
-  def __init__(self, list):
-    for l in list:
-      l = l.lower()
-      if l==c_and:
-        self.has_and = True
-      elif l==c_or:
-        self.has_or = True
-      elif l==c_not:
-        self.has_not = True
+  token_expression = re.compile(r"""
+    (?P<ws>\s+)|
+    (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")|
+    (?P<number>-?[0-9]+(?:\.[0-9]+)?)|
+    (?P<parameter>\{\s*[a-zA-Z_][a-zA-Z0-9_\.]*\s*\})|
+    (?P<symbol><=|>=|!=|==|=|<|>)|
+    (?P<word>[a-zA-Z_][a-zA-Z0-9_\.]*)|
+    (?P<punctuation>[\(\)\[\],])
+  """, re.VERBOSE|re.DOTALL)
+
+  keywords = ("AND", "OR", "NOT")
+
+  def tokenize(self, query):
+    tokens = []
+    pos = 0
+    length = len(query)
+    match = self.token_expression.match
+    while pos < length:
+      m = match(query, pos)
+      if not m:
+        raise QueryError("Unexpected character %r at position %d" % (query[pos], pos))
+      kind = m.lastgroup
+      value = m.group(kind)
+      if kind == "word" and value.upper() in self.keywords:
+        kind, value = value.upper(), value.upper()
+      if kind != "ws":
+        tokens.append((kind, value, pos))
+      pos = m.end()
+    tokens.append(("end", None, pos))
+    return tokens
+
+
+class parser(object):
+  """
+    A recursive descent parser for sproutcore queries:
+
+    expression := and_expression (OR and_expression)*
+    and_expression := not_expression (AND not_expression)*
+    not_expression := NOT not_expression | primary
+    primary := '(' expression ')' | comparison
+    comparison := field [NOT] operator value
+    value := scalar | list
+    scalar := string | number | {parameter} | field | constant
+    list := '(' scalar (',' scalar)* ')' | '[' scalar (',' scalar)* ']'
+
+    http://docs.sproutcore.com/symbols/SC.Query.html#constructor
+  """
+
+  #symbols and words that compare two values. The names are backend neutral,
+  #the compilers map them onto their own lookups.
+  operators = {
+    "=": "=",
+    "==": "=",
+    "!=": "!=",
+    "<": "<",
+    "<=": "<=",
+    ">": ">",
+    ">=": ">=",
+    "BEGINS_WITH": "BEGINS_WITH",
+    "ENDS_WITH": "ENDS_WITH",
+    "CONTAINS": "CONTAINS",
+    "ICONTAINS": "ICONTAINS",
+    "MATCHES": "MATCHES",
+    "ANY": "ANY",
+    "IN": "ANY",
+  }
+
+  #bare words that stand for constant values
+  constants = {
+    "TRUE": True,
+    "YES": True,
+    "FALSE": False,
+    "NO": False,
+    "NULL": None,
+    "UNDEFINED": None,
+  }
+
+  #guards the python stack against deeply nested queries
+  max_depth = 64
+
+  def __init__(self, tokens):
+    self.tokens = tokens
+    self.pos = 0
+    self.depth = 0
+
+  def peek(self):
+    return self.tokens[self.pos]
+
+  def next(self):
+    token = self.tokens[self.pos]
+    self.pos += 1
+    return token
+
+  def accept(self, kind, value=None):
+    token = self.tokens[self.pos]
+    if token[0] == kind and (value is None or token[1] == value):
+      self.pos += 1
+      return token
+    return None
+
+  def expect(self, kind, value=None):
+    token = self.accept(kind, value)
+    if token is None:
+      self.error("Expected %s" % (value or kind))
+    return token
+
+  def error(self, message):
+    kind, value, pos = self.peek()
+    if kind == "end":
+      raise QueryError("%s at the end of the query" % message)
+    raise QueryError("%s at position %d, found %r" % (message, pos, value))
+
+  def parse(self):
+    tree = self.parse_or()
+    if self.peek()[0] != "end":
+      self.error("Unexpected token")
+    return tree
+
+  def parse_or(self):
+    children = [self.parse_and()]
+    while self.accept("OR"):
+      children.append(self.parse_and())
+    if len(children) == 1:
+      return children[0]
+    return Or(children)
+
+  def parse_and(self):
+    children = [self.parse_not()]
+    while self.accept("AND"):
+      children.append(self.parse_not())
+    if len(children) == 1:
+      return children[0]
+    return And(children)
+
+  def parse_not(self):
+    self.depth += 1
+    if self.depth > self.max_depth:
+      self.error("The query is nested too deeply")
+    if self.accept("NOT"):
+      node = Not(self.parse_not())
+    else:
+      node = self.parse_primary()
+    self.depth -= 1
+    return node
+
+  def parse_primary(self):
+    if self.accept("punctuation", "("):
+      node = self.parse_or()
+      self.expect("punctuation", ")")
+      return node
+    return self.parse_comparison()
+
+  def parse_comparison(self):
+    kind, value, pos = self.peek()
+    if kind != "word" or value.upper() in self.constants:
+      self.error("Expected a field name")
+    field = self.next()[1]
+
+    negated = bool(self.accept("NOT"))
+
+    kind, value, pos = self.peek()
+    if kind == "symbol":
+      operator = self.operators[value]
+    elif kind == "word" and value.upper() in self.operators:
+      operator = self.operators[value.upper()]
+    else:
+      self.error("Expected an operator")
+    self.next()
+
+    kind, value, pos = self.peek()
+    if operator != "ANY" and kind == "punctuation" and value in ("(", "["):
+      self.error("Expected a single value, lists can only be compared with ANY")
+
+    return Comparison(field, operator, self.parse_value(), negated)
+
+  def parse_value(self):
+    kind, value, pos = self.peek()
+    if kind == "punctuation" and value in ("(", "["):
+      self.next()
+      closing = {"(": ")", "[": "]"}[value]
+      values = [self.parse_scalar()]
+      while self.accept("punctuation", ","):
+        values.append(self.parse_scalar())
+      self.expect("punctuation", closing)
+      return values
+    return self.parse_scalar()
+
+  def parse_scalar(self):
+    kind, value, pos = self.peek()
+    if kind == "string":
+      self.next()
+      return Literal(unescape(value[1:-1]))
+    elif kind == "number":
+      self.next()
+      if "." in value:
+        return Literal(float(value))
+      return Literal(int(value))
+    elif kind == "parameter":
+      self.next()
+      return Parameter(value[1:-1].strip())
+    elif kind == "word":
+      self.next()
+      if value.upper() in self.constants:
+        return Literal(self.constants[value.upper()])
+      return FieldReference(value)
+    self.error("Expected a value")
+
+
+def coerce_boolean(value):
+  """
+    Like BooleanField.to_python, but also accepts the lowercase spelling
+    and the sproutcore constants that clients send as strings.
+  """
+  if isinstance(value, basestring):
+    lowered = value.lower()
+    if lowered in ("t", "true", "yes", "1"):
+      return True
+    elif lowered in ("f", "false", "no", "0"):
+      return False
+    elif lowered in ("null", "none", ""):
+      return None
+  elif value in (True, False, None):
+    return value
+  raise ValidationError("%r is not a boolean value" % (value,))
+
+def field_coercer(field):
+  """
+    Returns a function that converts a value to the python type of the given
+    model field. Related fields are compared against the primary key of the
+    related model, so they convert to its type.
+  """
+  if field.rel:
+    field = field.rel.get_related_field()
+  if isinstance(field, (BooleanField, NullBooleanField)):
+    return coerce_boolean
+  return field.to_python
+
+
+def unescape(value):
+  """Removes the backslashes that escape quotes inside of string literals."""
+  if "\\" not in value:
+    return value
+  return re.sub(r"\\(.)", r"\1", value)
+
 
 class translator(object):
-  
-  #todo:
-  # - Support for NOT (not and, not or, not in, not contains, etc)
-  # - Support for parenthsis for grouping
-  # - Support for contains to understand whether it is a string or a colleciton
-  # - support for in / any collections
 
   """
   http://docs.sproutcore.com/symbols/SC.Query.html#constructor
@@ -74,223 +377,447 @@ class translator(object):
   Boolean Operators:
   AND
   OR
-  *NOT
+  NOT
   Parenthesis for grouping:
-  *( and )
+  ( and )
+
+  Every operator can be negated by prefixing it with NOT, i.e. "name NOT BEGINS_WITH 'a'".
   """
-  
+
   django_operators = {
     "BEGINS_WITH":"startswith", #or istartswith
     "ENDS_WITH": "endswith", #or iendswith
-    "NOT BEGINS_WITH":"~startswith", #or istartswith
-    "NOT ENDS_WITH": "~endswith", #or iendswith
     "CONTAINS": "contains", #or contains, if the right parm is a string, not a collection
     "ICONTAINS": "icontains", #or contains, if the right parm is a string, not a collection
-    "NOT CONTAINS": "~contains",
     "MATCHES": "regex", #or iregex
     "ANY": "in",
-    "NOT ANY": "~in",
     "=": "exact", #or iexact
     "!=": "~exact", #special.
     "<": "lt",
     ">": "gt",
     ">=": "gte",
     "<=": "lte",
-    "in": "in",
-    "NOT IN": "~in",
-    "NOT": "not"
   }
-  
-  stack = []
-  
-  """this expression finds the expression blocks in the whole statement"""
-  big_block_expression = None
-
-  """this expression finds field, operator, and value in one expression-block """
-  small_block_expression = None
-  
-  """
-    The init function compiles the regular expressions that are used to identify the blocks 
-  """
-  def __init__(self):
+
+  #operators that compare strings, their values are not coerced
+  string_operators = ("BEGINS_WITH", "ENDS_WITH", "CONTAINS", "ICONTAINS", "MATCHES")
+
+  #the number of compiled plans that are kept in the cache
+  cache_size = 256
+
+  #ANY sets with more values are split into several IN clauses, joined by OR,
+  #so that no single IN list is longer than backends allow (i.e. oracle's
+  #1000). The statement still binds every value, so sets above the backend's
+  #limit of bind parameters (i.e. 999 on some sqlite builds) still fail
+  in_chunk_size = 500
+
+  #queries with more characters are rejected before they are tokenized
+  max_length = 1024 * 1024
+
+  #marks a cache miss, since None is a valid (empty) plan
+  missing = object()
+
+  def __init__(self, model=None, cache_size=None, in_chunk_size=None,
+      max_length=None):
+    self.tokenizer = tokenizer()
+
+    if cache_size is not None:
+      self.cache_size = cache_size
+    if max_length is not None:
+      self.max_length = max_length
+    if in_chunk_size is not None:
+      self.in_chunk_size = in_chunk_size
+    self.cache = LRUCache(self.cache_size)
+
+    #the coercion tables of the queried model and the models related to it,
+    #and the coercion functions for every field path that was queried.
+    self.model = model
+    self.tables = {}
+    self.coercers = {}
+    if model is not None:
+      self.coercion_table(model)
+
+  def coercion_table(self, model):
     """
-      This expression matches actually one block expression in our statement. 
-      I.e. in the query "where name_field = 'Douglas Adams' and age>42" it would return
-      two matches: "name_field = 'Douglas Adams'"  and  "age<42"
+      Maps the names (and attribute names) of a model's fields, and the query
+      names of its reverse relations, to a (coercion function, related model)
+      tuple. Tables are built once per model.
     """
-    ex1 = """       # (name_field = 'Douglas Adams' and not)
-    [a-zA-Z\_\.]+       # Name of the Column that is to be queried
-                # name_field
-    \s?           # Optional whitespace between the Column and the operator
-    (?:%s)          # The list of operators (from django_operators) joined by a bitwise or (|)
-                # =
-    .*?           # Any whitespace and the value of the expression
-                # 'Douglas Adams'
-    (?:%s|$)+       # List of logical operations (and, or, not) as well as the end of the file
-                # 'and'
-    \s?           # Optional whitespace
-    (?:%s|$)?       # Another logical operation to also match (and not, or not, not and, not or)
-                # 'not'
-    """ % (self.operatorstring(), self.logicstring(), self.logicstring())
-    
+    table = self.tables.get(model)
+    if table is None:
+      table = {}
+      opts = model._meta
+      for field in list(opts.fields) + list(opts.many_to_many):
+        entry = (field_coercer(field), field.rel and field.rel.to or None)
+        table[field.name] = entry
+        table[field.attname] = entry
+      for related in opts.get_all_related_objects() + \
+          opts.get_all_related_many_to_many_objects():
+        # i.e. "choice" on a Poll, which compares the primary keys of choices.
+        table[related.field.related_query_name()] = (
+          field_coercer(related.model._meta.pk), related.model)
+      table["pk"] = (field_coercer(opts.pk), None)
+      self.tables[model] = table
+    return table
+
+  def coercer_for(self, path):
     """
-      This expression matches the different parts in one block expression.
-      I.e. in the expression 'name_field = 'Douglas Adams' it would return
-      three matches: "name_field", "=", and "Douglas Adams"
+      Follows a dotted field path (i.e. "poll.question", or "poll__question"
+      as django writes it) through the coercion tables and returns the
+      coercion function of the field it ends in, or None if the path is
+      unknown or the translator doesn't know its model.
     """
-    ex2 = """
-    ([a-zA-Z\_\.]+)     # The Name of the Column, this is group match 1
-                # 'name_field'
-    \s?           # Optional whitespace
-    (%s)          # The operator, this is group match 2
-                # '='
-    \s?           # Optional whitespace
-                # The value of the expression
-                # 'Douglas Adams'
-    (\'.*?\'|         # String value
-    \{.*?\}|        # A parameter value
-    [0-9]+|         # A Number value (currently, int only)
-    \(.*?\))        # A in or any value
-    """ % (self.operatorstring(),)
-    
-    self.big_block_expression = re.compile(ex1, re.IGNORECASE|re.DOTALL|re.VERBOSE)
-    self.small_block_expression = re.compile(ex2, re.IGNORECASE|re.DOTALL|re.VERBOSE)
-  
-  """
-    A couple of helper functions that comb through our operator dictionaries 
-  """
-  def logiclist(self):
-    return (c_and, c_or, c_not)
-  
-  def logicstring(self):
-    return "|".join(self.logiclist())
-  
-  def operatorlist(self):
-    return [re.escape(f) for f in self.django_operators.keys()]
-  
-  def operatorstring(self):
-    return "|".join(self.operatorlist())
-  
+    if path in self.coercers:
+      return self.coercers[path]
+
+    coercer = None
+    model = self.model
+    for part in path.replace("__", ".").split("."):
+      if model is None:
+        coercer = None
+        break
+      coercer, model = self.coercion_table(model).get(part, (None, None))
+      if coercer is None:
+        break
+    if coercer is not None:
+      # Unknown paths are not remembered, since clients can send any number of them.
+      self.coercers[path] = coercer
+    return coercer
+
+  def coerce(self, node, value):
+    """
+      Coerces a value to the type of the field the comparison looks at.
+      Lists are only valid for ANY, which coerces them element-wise.
+      Raises a QueryError if the value can't be converted.
+    """
+    if isinstance(value, (list, tuple)):
+      if node.operator != "ANY":
+        raise QueryError("The field '%s' can only be compared to a list with ANY"
+          % node.field)
+      return [self.coerce(node, v) for v in value]
+    if node.operator in self.string_operators or value is None:
+      return value
+    coercer = self.coercer_for(node.field)
+    if coercer is None:
+      return value
+    try:
+      return coercer(value)
+    except (ValidationError, TypeError, ValueError):
+      raise QueryError("The value %r is not valid for the field '%s'" % (value, node.field))
+
+  def coerce_literals(self, node):
+    """
+      Walks the syntax tree and coerces all literal values in place.
+    """
+    if isinstance(node, Comparison):
+      if isinstance(node.value, Literal):
+        node.value = Literal(self.coerce(node, node.value.value))
+      elif isinstance(node.value, list):
+        node.value = [isinstance(v, Literal) and Literal(self.coerce(node, v.value)) or v
+          for v in node.value]
+    elif isinstance(node, Not):
+      self.coerce_literals(node.child)
+    else:
+      for child in node.children:
+        self.coerce_literals(child)
+
   def parse(self, query, parameters = {}):
     """
       This function receives a sproutcore query and optional parameters,
       parses them, and returns a django Q object that can be used
       to filter the database in question
     """
+    return self.bind(self.compile(query), parameters)
+
+  def compile(self, query):
+    """
+      Turns a sproutcore query into a syntax tree that does not depend on the
+      request parameters. Trees are kept in an LRU cache keyed by the
+      query's tokens joined by single spaces, so queries which only differ
+      in their formatting are only parsed once.
+
+      Raises a QueryError if the query is too long or malformed.
+    """
+    if len(query) > self.max_length:
+      raise QueryError("The query is longer than %d characters" % self.max_length)
+    tokens = self.tokenizer.tokenize(query)
+    key = " ".join([value for kind, value, pos in tokens[:-1]])
+    plan = self.cache.get(key, self.missing)
+    if plan is self.missing:
+      plan = self.build_plan(tokens)
+      self.cache.set(key, plan)
+    return plan
 
-    #if the query is empty, return an empty obj
-    if len(query.strip())=="":
+  def build_plan(self, tokens):
+    """
+      Parses the tokens of a query. An empty query results in an empty plan.
+    """
+    if len(tokens) == 1:
       return None
+    tree = parser(tokens).parse()
+    if self.model is not None:
+      self.coerce_literals(tree)
+    return tree
 
-    self.stack = []
-    
-    ##first step, break into AND, or OR blocks
-    m = self.big_block_expression.findall(query)
-
-    #if there were no blocks, return none
-    if m==None or len(m)==0:return None
-    
-    #No loop through the blocks and try to identify the parts
-    for exp in m:
-      if exp.strip()=="":continue
-      
-      #parse the individual group
-      m = self.small_block_expression.search(exp)
-      if m:
-        if len(m.groups())==3:
-          self.stack.append(m.groups())
-      combinatorList = re.findall("(?:%s)+$" % (self.logicstring()), exp.strip(), re.IGNORECASE)
-      if combinatorList != None:
-        self.stack.append(combinatorList)
-    
-    #The main Q object
-    obj = None
-    combinator = None #the current logical combination expression
-
-    def convert_value(value):
-      """
-        Convert the value that comes in as string to
-        the right python datatype.
-        Currently supports conversion to 
-        int, string, tuple
-      """
-      #TODO: Use the Django Type Information from the model to
-      #convert these to the right datatype (i.e. date, etc)
-
-      #If we have a non-string alredy, return it
-      if type(value)!=type(""):return value
-
-      value = value.replace("'", "")
-      
-      #this is a number value
-      if re.match("^[0-9]+$", value):
-        return int(value)
-      #this is a collection. we could also match against \(.*?\) but that takes longer and the solution below should suffice
-      elif value[0]=="(":
-        return [convert_value(x.strip()) 
-              for x in tuple(value[1:-1].split(','))] #recursive list comprehension ftw.
-      #string
-      else:
-        return value
-
-    def evaluate_not(n, obj):
-      """
-        return a django Q object, and invert it, based on the value of n
-      """
-      if n:
-        return ~obj
+  def bind(self, plan, parameters = {}):
+    """
+      Binds the request parameters into a syntax tree and returns the
+      resulting django Q object.
+    """
+    if plan is None:
+      return None
+    return self.compile_node(plan, parameters)
+
+  def compile_node(self, node, parameters):
+    if isinstance(node, Comparison):
+      return self.compile_comparison(node, parameters)
+    elif isinstance(node, Not):
+      return ~self.compile_node(node.child, parameters)
+
+    # Build one Q node holding all children, instead of chaining & and |,
+    # since every combination copies the Q objects combined so far.
+    q = Q(*[self.compile_node(child, parameters) for child in node.children])
+    if isinstance(node, Or):
+      q.connector = Q.OR
+    return q
+
+  def compile_comparison(self, node, parameters):
+    operator = self.django_operators[node.operator]
+    value = self.resolve_value(node, node.value, parameters)
+
+    #if the field contains dots, these have to be converted to __ as that is the django field seperator
+    #also, we need to convert to ascii, as django does not support unicode key fields
+    field = node.field.replace(".", "__").encode('ascii')
+
+    key = "%s__%s" % (field, operator.replace("~", ""))
+    if operator == "in":
+      q = self.compile_in(key, value)
+    else:
+      q = Q(**{key: value})
+
+    #django doesn't have an equivalent to != so the opposite expression
+    #is inverted instead.
+    if operator[0] == "~":
+      q = ~q
+    if node.negated:
+      q = ~q
+    return q
+
+  def compile_in(self, key, values):
+    """
+      Compiles an ANY comparison. Single values are treated as sets with one
+      value, duplicates are dropped, and large sets are split into several
+      IN lists of one statement. This only bounds the length of each list,
+      not the number of bind parameters of the statement; bulk/ fetches
+      large sets of keys with one query per chunk instead.
+    """
+    if not isinstance(values, (list, tuple, set)):
+      values = [values]
+    seen = set()
+    try:
+      values = [v for v in values if not (v in seen or seen.add(v))]
+    except TypeError:
+      raise QueryError("The values of %s must be numbers or strings" % key)
+
+    size = self.in_chunk_size
+    if len(values) <= size:
+      return Q(**{key: values})
+    q = Q(*[Q(**{key: values[i:i + size]}) for i in range(0, len(values), size)])
+    q.connector = Q.OR
+    return q
+
+  def resolve_value(self, node, value, parameters):
+    if isinstance(value, list):
+      return [self.resolve_value(node, v, parameters) for v in value]
+    elif isinstance(value, Parameter):
+      if value.name not in parameters:
+        raise QueryError("The query parameter '%s' is missing" % value.name)
+      return self.coerce(node, parameters[value.name])
+    elif isinstance(value, FieldReference):
+      return F(value.name.replace(".", "__").encode('ascii'))
+    return value.value
+
+
+class datastore_compiler(object):
+  """
+    Compiles a syntax tree into AppEngine datastore filters, i.e.
+    [("votes >=", 3), ("answer IN", ["Red", "Blue"])], and the sort orders
+    the datastore needs to run them.
+
+    The datastore can only AND its filters, so:
+    - OR is only supported between = comparisons on the same field, which
+      become a single IN filter
+    - NOT is only supported in front of a single comparison
+    - CONTAINS, ICONTAINS, ENDS_WITH and MATCHES are not supported, and
+      BEGINS_WITH becomes a range on the field
+    - relations can't be followed, and fields can't be compared to fields
+    - inequality filters can only be used on one field
+
+    Everything the datastore can't run is reported by `problems`, and
+    `compile` raises a QueryError for such queries.
+  """
+  datastore_operators = {
+    "=": "=",
+    "!=": "!=",
+    "<": "<",
+    "<=": "<=",
+    ">": ">",
+    ">=": ">=",
+    "ANY": "IN",
+  }
+
+  negated_operators = {
+    "=": "!=",
+    "!=": "=",
+    "<": ">=",
+    "<=": ">",
+    ">": "<=",
+    ">=": "<",
+  }
+
+  inequality_operators = ("!=", "<", "<=", ">", ">=")
+
+  def __init__(self, translator, key=None):
+    """
+      The translator resolves and coerces the parameters. `key` converts the
+      values that are compared against "pk" into datastore keys.
+    """
+    self.translator = translator
+    self.key = key
+
+  def problems(self, plan):
+    """
+      Returns a list with a message for every part of the query that the
+      datastore can't run. An empty list means that the whole query can be
+      pushed down to the datastore.
+    """
+    problems = []
+    if plan is not None:
+      self.check(plan, False, problems)
+      inequalities = set([f for f, op, negated in self.comparisons(plan)
+        if self.operator(op, negated) in self.inequality_operators
+        or op == "BEGINS_WITH"])
+      if len(inequalities) > 1:
+        problems.append("inequality filters can only be used on one field, not on %s"
+          % ", ".join(sorted(inequalities)))
+    return problems
+
+  def check(self, node, negated, problems):
+    if isinstance(node, Comparison):
+      negated = negated != node.negated
+      if "." in node.field:
+        problems.append("relations can't be followed ('%s')" % node.field)
+      if isinstance(node.value, FieldReference):
+        problems.append("'%s' can't be compared to another field" % node.field)
+      if node.operator not in self.datastore_operators and node.operator != "BEGINS_WITH":
+        problems.append("%s is not supported" % node.operator)
+      elif negated and node.operator in ("ANY", "BEGINS_WITH"):
+        problems.append("NOT %s is not supported" % node.operator)
+    elif isinstance(node, Not):
+      if not isinstance(node.child, Comparison):
+        problems.append("NOT can only be used in front of a comparison")
       else:
-        return obj
-
-    for entry in self.stack:
-      if type(entry)==type(()): #got a tuple
-
-        #this shouldn't happen, but nevertheless check for it to prevent accidental breaking here.
-        if len(entry)!=3:continue
-
-        lfield = entry[0]
-        operator = self.django_operators[entry[1]]
-        rfield = entry[2]
-
-        #if the lfield contains dots, these have to be converted to __ as that is the django field seperator
-        lfield = lfield.replace(".", "__")
-        
-        #try to find a replacement for the rfield in our parameters
-        if rfield.find("{")!=-1:
-          rfield_ = rfield.replace("{", "").replace("}", "")
-          if parameters.get(rfield_):
-            rfield = parameters.get(rfield_)
-
-        #we have to try to convert the object type to int
-        rfield = convert_value(rfield)
-
-        kwargs = {
-          #we remove the ~ that was added to mark inverted values
-	  #also, we need to covnert to ascii, as django does not support unicode key fields
-          "%s__%s" % (lfield.encode('ascii') , operator.replace("~", "")):
-          rfield
-        }
-        
-        #create a q object
-        if combinator:
-          
-          #if the obj operator contains a ~ we have to invert it. this is because django doesn't have a
-          #equivalent to != or not contains. instead, the opposite expresion has to be used.
-          if operator[0]=="~":
-            if combinator.has_not: combinator.has_not=False
-            else: combinator.has_not=True
-          
-          if combinator.has_and:
-            obj = obj & evaluate_not(combinator.has_not, Q(**kwargs))
-          elif combinator.has_or:
-            obj = obj | evaluate_not(combinator.has_not, Q(**kwargs))
-        else:
-          obj = evaluate_not(not operator.find("~"), Q(**kwargs))
-      
-      if obj and type(entry)==type([]):
-        combinator = logic_expression(entry)
-    
-    return obj
+        self.check(node.child, not negated, problems)
+    elif isinstance(node, Or):
+      fields = set()
+      for child in node.children:
+        if not isinstance(child, Comparison) or child.operator != "=" \
+          or child.negated or negated:
+          problems.append("OR can only be used between = comparisons")
+          return
+        fields.add(child.field)
+      if len(fields) > 1:
+        problems.append("OR can only be used between comparisons on the same field")
+      for child in node.children:
+        self.check(child, negated, problems)
+    else:
+      for child in node.children:
+        self.check(child, negated, problems)
+
+  def comparisons(self, node, negated=False):
+    """Yields (field, operator, negated) for every comparison in the tree."""
+    if isinstance(node, Comparison):
+      yield node.field, node.operator, negated != node.negated
+    elif isinstance(node, Not):
+      for comparison in self.comparisons(node.child, not negated):
+        yield comparison
+    else:
+      for child in node.children:
+        for comparison in self.comparisons(child, negated):
+          yield comparison
+
+  def operator(self, operator, negated):
+    if negated:
+      return self.negated_operators.get(operator, operator)
+    return operator
+
+  def compile(self, plan, parameters = {}):
+    """
+      Returns the list of (property and operator, value) filters for the plan.
+      Raises a QueryError if the datastore can't run the query.
+    """
+    if plan is None:
+      return []
+    problems = self.problems(plan)
+    if problems:
+      raise QueryError("The datastore can't run this query: %s" % "; ".join(problems))
+    filters = []
+    self.compile_node(plan, parameters, False, filters)
+    return filters
+
+  def compile_node(self, node, parameters, negated, filters):
+    if isinstance(node, Comparison):
+      self.compile_comparison(node, parameters, negated != node.negated, filters)
+    elif isinstance(node, Not):
+      self.compile_node(node.child, parameters, not negated, filters)
+    elif isinstance(node, Or):
+      values = [self.value(child, parameters) for child in node.children]
+      filters.append(("%s IN" % self.field(node.children[0]), values))
+    else:
+      for child in node.children:
+        self.compile_node(child, parameters, negated, filters)
+
+  def compile_comparison(self, node, parameters, negated, filters):
+    field = self.field(node)
+    value = self.value(node, parameters)
+    if node.operator == "BEGINS_WITH":
+      if not isinstance(value, basestring):
+        raise QueryError("BEGINS_WITH needs a string, not %r" % (value,))
+      filters.append(("%s >=" % field, value))
+      filters.append(("%s <" % field, value + u"\ufffd"))
+      return
+    if node.operator == "ANY" and not isinstance(value, (list, tuple)):
+      value = [value]
+    operator = self.datastore_operators[self.operator(node.operator, negated)]
+    filters.append(("%s %s" % (field, operator), value))
+
+  def field(self, node):
+    if node.field == "pk":
+      return "__key__"
+    return str(node.field)
+
+  def value(self, node, parameters):
+    value = self.translator.resolve_value(node, node.value, parameters)
+    if node.field == "pk" and self.key is not None:
+      if isinstance(value, (list, tuple)):
+        return [self.key(v) for v in value]
+      return self.key(value)
+    return value
+
+  def orders(self, filters, ordering=()):
+    """
+      Returns the sort orders for the filters. The datastore requires the
+      field of an inequality filter to be sorted on first.
+    """
+    ordering = list(ordering)
+    for name, value in filters:
+      # Plain lookups (i.e. "answer") compare for equality.
+      field, _, operator = name.partition(" ")
+      if operator in self.inequality_operators:
+        if not ordering or ordering[0].lstrip("-") != field:
+          ordering.insert(0, field)
+        break
+    return ordering
 
 
 if __name__=="__main__":
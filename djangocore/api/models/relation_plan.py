@@ -0,0 +1,140 @@
+"""
+The `relations` parameter tells the serializer which related objects to
+include, i.e. {"poll": {}, "choice_set": {"relations": ["poll"]}}. Followed
+lazily, every relation costs one query per serialized object. This module
+compiles the spec into a plan for the query set instead:
+
+- to-one paths (foreign keys and one-to-one fields) that are only reached
+  through other to-one paths are joined with select_related
+- everything else (reverse foreign keys, many-to-many fields and whatever
+  hangs below them) is fetched with prefetch_related, one pk__in query per
+  path
+
+so a page costs one query plus one per prefetched path, however many
+objects it holds.
+
+"""
+# Standard library dependencies.
+import json
+
+# Intra-app dependencies.
+from djangocore.utils import LRUCache
+from query_translator import QueryError
+
+ONE = 'one'
+MANY = 'many'
+
+class RelationPlan(object):
+    """The select_related and prefetch_related paths for one relations spec."""
+    def __init__(self, select=(), prefetch=()):
+        self.select = tuple(select)
+        self.prefetch = tuple(prefetch)
+
+    def apply(self, qs):
+        qs = qs._clone()
+        # Replaces the joins of a plain select_related() with the planned ones.
+        qs.query.select_related = False
+        if self.select:
+            qs = qs.select_related(*self.select)
+        if self.prefetch:
+            qs = qs.prefetch_related(*self.prefetch)
+        return qs
+
+class RelationPlanner(object):
+    """
+    Compiles relations specs into RelationPlans for the given model. The plans
+    are cached by their spec string.
+
+    """
+    cache_size = 64
+
+    def __init__(self, model, cache_size=None):
+        if cache_size is not None:
+            self.cache_size = cache_size
+        self.model = model
+        self.cache = LRUCache(self.cache_size)
+        self.tables = {}
+
+    def plan(self, spec):
+        """
+        Returns the plan for a relations spec, given as a JSON string or as
+        the decoded spec. Raises a QueryError for malformed specs and for names
+        that are not relations of their model.
+
+        """
+        if isinstance(spec, basestring):
+            key = spec
+            plan = self.cache.get(key)
+            if plan is not None:
+                return plan
+            try:
+                spec = json.loads(spec)
+            except ValueError:
+                raise QueryError("The relations are not valid JSON")
+        else:
+            key = None
+
+        select, prefetch = [], []
+        self.walk(self.model, spec, "", True, select, prefetch)
+        plan = RelationPlan(select, prefetch)
+        if key is not None:
+            self.cache.set(key, plan)
+        return plan
+
+    def walk(self, model, spec, prefix, joinable, select, prefetch):
+        if isinstance(spec, dict):
+            items = spec.items()
+        elif isinstance(spec, (list, tuple)):
+            items = [(name, {}) for name in spec]
+        elif isinstance(spec, basestring):
+            items = [(spec, {})]
+        elif not spec:
+            return
+        else:
+            raise QueryError("The relations must be a list or an object")
+
+        table = self.relation_table(model)
+        for name, options in items:
+            name = str(name)
+            if name not in table:
+                raise QueryError("%s has no relation named '%s'"
+                    % (model._meta.object_name, name))
+            kind, related = table[name]
+            path = prefix + name
+
+            if kind == ONE and joinable:
+                select.append(path)
+                child_joinable = True
+            else:
+                # Everything below a prefetched relation is prefetched as well.
+                prefetch.append(path)
+                child_joinable = False
+
+            if isinstance(options, dict) and options.get('relations'):
+                self.walk(related, options['relations'], path + "__",
+                    child_joinable, select, prefetch)
+
+    def relation_table(self, model):
+        """
+        Maps the names the serializer knows a model's relations by (field names
+        and reverse accessor names) to a (kind, related model) tuple.
+
+        """
+        table = self.tables.get(model)
+        if table is None:
+            table = {}
+            opts = model._meta
+            for field in opts.fields:
+                if field.rel:
+                    table[field.name] = (ONE, field.rel.to)
+            for field in opts.many_to_many:
+                table[field.name] = (MANY, field.rel.to)
+            for related in opts.get_all_related_objects():
+                # Reverse one-to-one relations can't be joined by
+                # select_related in this django version, so they are
+                # prefetched like reverse keys.
+                table[related.get_accessor_name()] = (MANY, related.model)
+            for related in opts.get_all_related_many_to_many_objects():
+                table[related.get_accessor_name()] = (MANY, related.model)
+            self.tables[model] = table
+        return table
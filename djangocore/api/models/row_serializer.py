@@ -0,0 +1,176 @@
+"""
+A row serializer is compiled once per resource (and per projection) from the
+model's fields. It turns values_list tuples, or model instances, straight into
+the records of the wire format:
+
+    {"pk": 1, "model": "polls.choice", "fields": {"poll": 1, "answer": "Blue"}}
+
+without going through django's serializers, which look up how to serialize
+every field of every object again. The values come out the way the emitter
+would have deconstructed them, so the records are returned in a PrimitiveList
+that the emitter doesn't walk again.
+
+The columns layout sends the model label and the field names once, followed
+by the values of every object as a row:
+
+    [{"model": "polls.choice", "columns": ["pk", "poll", "answer"]},
+     [1, 1, "Blue"], [2, 1, "Red"]]
+
+The first column is always the primary key.
+
+"""
+# Django dependencies.
+from django.db.models.query import QuerySet
+from django.utils.encoding import smart_unicode, force_unicode, \
+    is_protected_type
+
+# Intra-app dependencies.
+from djangocore.utils import PrimitiveList
+
+# Field types whose values are already what the emitter sends.
+PLAIN_TYPES = ("AutoField", "BigIntegerField", "BooleanField", "CharField",
+    "CommaSeparatedIntegerField", "DateField", "DateTimeField", "EmailField",
+    "FloatField", "IntegerField", "NullBooleanField", "PositiveIntegerField",
+    "PositiveSmallIntegerField", "SlugField", "SmallIntegerField", "TextField",
+    "TimeField", "URLField", "IPAddressField", "GenericIPAddressField")
+
+def plain(value):
+    return value
+
+def decimal_string(value):
+    # The emitter sends decimals as strings, to keep their precision.
+    if value is None:
+        return None
+    return str(value)
+
+def primitive(value):
+    # Like the python serializer, which falls back to value_to_string.
+    if is_protected_type(value):
+        return value
+    return force_unicode(value)
+
+def field_converter(field):
+    """Returns the function that converts a value of the field for the wire."""
+    if field.rel:
+        field = field.rel.get_related_field()
+    internal_type = field.get_internal_type()
+    if internal_type in PLAIN_TYPES:
+        return plain
+    if internal_type == "DecimalField":
+        return decimal_string
+    return primitive
+
+class RowSerializer(object):
+    """
+    Serializes the objects of a model. Only the given fields are serialized,
+    if given, otherwise all of them, as django's serializers do. An empty
+    list serializes only the keys.
+
+    """
+    def __init__(self, model, fields=None):
+        opts = model._meta
+        self.model = model
+        self.label = smart_unicode(opts)
+
+        self.fields = [] # (name, attname, converter) of the local fields
+        concrete_model = getattr(opts, "concrete_model", model)
+        for field in concrete_model._meta.local_fields:
+            if field.serialize and (fields is None or field.name in fields):
+                self.fields.append((field.name, field.attname,
+                    field_converter(field)))
+        self.many_to_many = [field for field in opts.many_to_many
+            if field.serialize and field.rel.through._meta.auto_created
+            and (fields is None or field.name in fields)]
+
+        self.pk_converter = field_converter(opts.pk)
+        self.columns = ["pk"] + [name
+            for name, attname, converter in self.fields]
+
+    def serialize(self, model_or_iterable, columns=False):
+        """
+        Returns the records of a query set, a list of objects or a single
+        object, or their rows in the columns layout. Query sets are read with
+        values_list, so no model instances are created.
+
+        """
+        if isinstance(model_or_iterable, QuerySet):
+            rows = self.rows(model_or_iterable)
+        else:
+            if not hasattr(model_or_iterable, "__iter__"):
+                model_or_iterable = [model_or_iterable]
+            attnames = [attname for name, attname, converter in self.fields]
+            rows = [[obj.pk] + [getattr(obj, a) for a in attnames]
+                for obj in model_or_iterable]
+        if columns:
+            return self.serialize_columns(rows)
+        return self.serialize_rows(rows)
+
+    def rows(self, qs):
+        """Returns the query set as the rows that serialize_rows takes."""
+        return qs.values_list(*self.columns)
+
+    def serialize_rows(self, rows):
+        pk_converter = self.pk_converter
+        fields = [(name, converter)
+            for name, attname, converter in self.fields]
+        records = PrimitiveList()
+        for row in rows:
+            values = {}
+            for i, (name, converter) in enumerate(fields):
+                values[name] = converter(row[i + 1])
+            records.append({"pk": pk_converter(row[0]), "model": self.label,
+                "fields": values})
+
+        if self.many_to_many and records:
+            self.add_many_to_many(records)
+        return records
+
+    def header(self):
+        """Returns the first item of the columns layout."""
+        return {"model": self.label,
+            "columns": self.columns + [field.name
+                for field in self.many_to_many]}
+
+    def serialize_columns(self, rows, header=True):
+        """
+        Returns the rows in the columns layout, without the header if
+        `header` is false, i.e. for all but the first batch of a stream.
+
+        """
+        converters = [self.pk_converter] + [converter
+            for name, attname, converter in self.fields]
+        records = PrimitiveList()
+        for row in rows:
+            records.append([convert(value)
+                for convert, value in zip(converters, row)])
+
+        if self.many_to_many and records:
+            pks = [record[0] for record in records]
+            for field in self.many_to_many:
+                related = self.related_keys(field, pks)
+                for record in records:
+                    record.append(related.get(record[0], []))
+        if header:
+            records.insert(0, self.header())
+        return records
+
+    def add_many_to_many(self, records):
+        """Adds the keys of the many to many relations, with one query per
+        field."""
+        pks = [record["pk"] for record in records]
+        for field in self.many_to_many:
+            related = self.related_keys(field, pks)
+            for record in records:
+                record["fields"][field.name] = related.get(record["pk"], [])
+
+    def related_keys(self, field, pks):
+        """Maps the given pks to the keys of their objects in a many to many
+        field."""
+        source = field.m2m_field_name()
+        target = field.m2m_reverse_field_name()
+        related = {}
+        for pk, related_pk in field.rel.through._default_manager.filter(
+                **{"%s__in" % source: pks}).values_list(source, target):
+            related.setdefault(pk, []).append(smart_unicode(related_pk,
+                strings_only=True))
+        return related
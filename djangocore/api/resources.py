@@ -1,10 +1,15 @@
 # Django dependencies.
-from django.http import HttpResponseNotAllowed, Http404
+from django.http import HttpResponseNotAllowed, HttpResponseNotModified, \
+    Http404
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, \
+    quote_etag
+from django.utils.cache import patch_vary_headers
 from django.conf.urls.defaults import patterns, url, include
 
 # Intra-app dependencies.
 from djangocore.utils import underscore
-from djangocore.serialization import mimer, MalformedData, EmittableResponse
+from djangocore.serialization import mimer, emitter, MalformedData, \
+    BodyTooLarge, EmittableResponse
 
 
 class BaseResource(object):
@@ -15,6 +20,13 @@ class BaseResource(object):
     """
     anonymous = False # When set to True, skips authenticating requests entirely.
     allowed_operations = () # Filters handler functions if given. See `ops` below.
+    compress_min_size = 1024 # Smallest body that is compressed; None disables.
+
+    # Options a POSTed JSON object may send as lists of names, or as booleans.
+    # These and the other options below have to be strings otherwise.
+    list_options = ('fields', 'ordering')
+    flag_options = ('with_total', 'estimate', 'stream', 'pretty')
+    string_options = ('conditions', 'format', 'layout', 'cursor')
     
     class Auth:
         pass
@@ -94,7 +106,64 @@ class BaseResource(object):
         # Deserialize the data we recieved, if any.
         if request.method in ('PUT', 'POST'):
             mimer.translate(request)
+            data = getattr(request, 'data', None)
+            if request.method == 'POST' and isinstance(data, dict):
+                request.posted_options = self.clean_options(data)
+
+    def clean_options(self, data):
+        """
+        Returns a copy of a POSTed JSON object, with the lists and booleans
+        it sends as options joined and spelled the way the GET parameters
+        would be. Raises MalformedData for options of any other type.
+        
+        """
+        options = {}
+        for k, v in data.items():
+            if k in self.list_options and isinstance(v, list) and \
+                    all([isinstance(name, basestring) for name in v]):
+                v = ','.join(v)
+            elif k in self.flag_options and isinstance(v, bool):
+                v = v and 'true' or 'false'
+            elif not isinstance(v, basestring) and k in self.list_options + \
+                    self.flag_options + self.string_options:
+                raise MalformedData("The '%s' option sent in the request is "
+                    "not valid" % k)
+            options[k] = v
+        return options
     
+    def process_response(self, response, request):
+        """
+        Serializes the response in the format the client asked for, with
+        ``?format=`` or else the ``Accept`` header, and compresses it if the
+        client accepts gzip or deflate.
+        
+        """
+        options = self.get_options(request)
+        format = options.get('format') or \
+            emitter.format_for_accept(request.META.get('HTTP_ACCEPT'))
+        pretty = options.get('pretty') in ('1', 'true')
+        encoding = None
+        if self.compress_min_size is not None:
+            encoding = emitter.encoding_for_accept(
+                request.META.get('HTTP_ACCEPT_ENCODING'))
+        response = emitter.translate(format, response, pretty=pretty,
+            encoding=encoding, min_size=self.compress_min_size)
+        patch_vary_headers(response, ('Accept', 'Accept-Encoding'))
+        return response
+
+    def get_options(self, request):
+        """
+        Returns a mutable copy of the GET parameters. Requests can also POST
+        their parameters as a JSON object, i.e. to send ANY sets that are too
+        large for a URL. Its keys are merged into the GET parameters, after
+        process_request cleaned them. See clean_options.
+        
+        """
+        options = request.GET.copy()
+        for k, v in getattr(request, 'posted_options', {}).items():
+            options[k] = v
+        return options
+
     def mapper(self, request, **ops):
         """
         Maps a given url and request method to a given handler function.
@@ -111,18 +180,66 @@ class BaseResource(object):
             return HttpResponseNotAllowed(ops.keys())
         
         if not self.is_authenticated(request, handler):
-            return EmittableResponse("", status=403)
+            return self.process_response(EmittableResponse("", status=403),
+                request)
+
+        etag = last_modified = None
+        if request.method in ('GET', 'HEAD'):
+            # Answer conditional requests before the handler does any work.
+            etag, last_modified = self.get_validators(request, handler)
+            if self.not_modified(request, etag, last_modified):
+                return self.set_validators(HttpResponseNotModified(), etag,
+                    last_modified)
                 
         try:
             self.process_request(request)
         except MalformedData, err:
             # The data sent in the request was malformed.
-            return EmittableResponse(str(err), status=400)
+            return self.process_response(EmittableResponse(str(err),
+                status=400), request)
+        except BodyTooLarge, err:
+            return self.process_response(EmittableResponse(str(err),
+                status=413), request)
         
         response = handler(request)
 
         response = self.process_response(response, request)
 
+        if getattr(response, 'status_code', None) == 200:
+            self.set_validators(response, etag, last_modified)
+        return response
+
+    def get_validators(self, request, handler):
+        """
+        Returns an (etag, last modified timestamp) tuple for the response
+        the handler would return for a GET request, either of which can be
+        None. Validators have to be cheap, since they are computed before the
+        handler runs. Resources don't validate responses by default.
+        
+        """
+        return None, None
+
+    def not_modified(self, request, etag, last_modified):
+        """
+        Returns True if the client's copy of the response, as identified by
+        the If-None-Match or If-Modified-Since headers, is still current.
+        
+        """
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            # If-None-Match takes precedence over If-Modified-Since.
+            return etag is not None and (if_none_match.strip() == '*'
+                or etag in parse_etags(if_none_match))
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        return last_modified is not None and if_modified_since is not None \
+            and int(last_modified) <= if_modified_since
+
+    def set_validators(self, response, etag, last_modified):
+        if etag is not None:
+            response['ETag'] = quote_etag(etag)
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
         return response
 
 # TODO: Add in some way to catch errors...        
@@ -3,20 +3,29 @@ try:
 except ImportError:
     import StringIO
 
+import zlib
+from itertools import chain
+
 try:
     import yaml
 except ImportError:
     yaml = None
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 from django.conf import settings
 from django.utils import simplejson
-from django.utils.encoding import force_unicode
+from django.utils.encoding import force_unicode, smart_str
 from django.utils.xmlutils import SimplerXMLGenerator
 from django.http import HttpResponse, HttpResponseBadRequest
 from django.core.serializers.json import DjangoJSONEncoder 
+from django.utils.importlib import import_module
 
-from djangocore.utils import deconstruct
+from djangocore.utils import deconstruct, LRUCache, PrimitiveList
 
 class EmittableResponse(object):
     """A thin wrapper for returning an HttpResponse whose contents can be 
@@ -25,6 +34,11 @@ class EmittableResponse(object):
         self.content = content
         self.ops = ops
 
+class StreamableResponse(EmittableResponse):
+    """An EmittableResponse whose content is an iterable of items, that is
+    only consumed while the response is sent to the client."""
+    pass
+
 class AlreadyRegistered(Exception):
     """Raised when trying to register a content type that has already
     been registered."""
@@ -38,46 +52,109 @@ class NotRegistered(Exception):
 class MalformedData(Exception):
     """Raised when loading the data in the request body fails."""
     pass
+
+class BodyTooLarge(Exception):
+    """Raised when the request body is larger than the
+    SPROUTCORE_MAX_BODY_SIZE setting allows."""
+    pass
+
+# Parsed Content-Type headers, keyed by the header.
+_media_types = LRUCache(256)
+
+def parse_media_type(ctype):
+    """
+    Splits a ``Content-Type`` header into its lowercased media type and a
+    dict of its parameters, i.e. 'application/json; charset=UTF-8' into
+    ('application/json', {'charset': 'UTF-8'}).
+    
+    """
+    parsed = _media_types.get(ctype)
+    if parsed is None:
+        parts = ctype.split(';')
+        params = {}
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip():
+                params[name.strip().lower()] = value.strip().strip('"')
+        parsed = (parts[0].strip().lower(), params)
+        _media_types.set(ctype, parsed)
+    return parsed
     
 class Mimer(object):
+    formencoded_ctype = "application/x-www-form-urlencoded"
+    max_body_size = 10 * 1024 * 1024
+
     def __init__(self):
         self._registry = {}
+        self._streams = set()
+        
+    def register(self, ctype_or_iterable, mimer, stream=False):
+        """
+        Registers a mimer function for one or more media types. Parameters
+        like the charset don't take part in the lookup. Stream mimers are
+        passed the request, to read the body from, instead of the body.
         
-    def register(self, ctype_or_iterable, mimer):
+        """
         if isinstance(ctype_or_iterable, basestring):
             ctype_or_iterable = [ctype_or_iterable]
         for ctype in ctype_or_iterable:
+            ctype = parse_media_type(ctype)[0]
             if ctype in self._registry:
                 raise AlreadyRegistered("The content type %s is already "
                   "registered" % ctype)
             self._registry[ctype] = mimer
+            if stream:
+                self._streams.add(ctype)
         
     def unregister(self, ctype_or_iterable):
         if isinstance(ctype_or_iterable, basestring):
             ctype_or_iterable = [ctype_or_iterable]
         for ctype in ctype_or_iterable:
+            ctype = parse_media_type(ctype)[0]
             if ctype not in self._registry:
                 raise NotRegistered("The content type %s is not registered"
                   % ctype)
             del self._registry[ctype]
+            self._streams.discard(ctype)
     
     def mimer_for_ctype(self, ctype):
-        return self._registry.get(ctype, None)
+        return self._registry.get(parse_media_type(ctype)[0], None)
 
     def content_type(self, request):
         """
-        Returns the content type of the request, except when the request
-        is form-encoded or contains multipart form data.
+        Returns the media type of the request, without its parameters,
+        except when the request is form-encoded or contains multipart form
+        data.
         
         """
-        formencoded_ctype = "application/x-www-form-urlencoded"
-
-        ctype = request.META.get('CONTENT_TYPE', formencoded_ctype).strip()
-        if ctype.startswith(formencoded_ctype) or ctype.startswith('multipart'):
+        ctype = parse_media_type(request.META.get('CONTENT_TYPE',
+            self.formencoded_ctype))[0]
+        if ctype == self.formencoded_ctype or ctype.startswith('multipart/'):
             return None
         
         return ctype
 
+    def check_body_size(self, request):
+        """
+        Raises BodyTooLarge if the request announces a body larger than
+        SPROUTCORE_MAX_BODY_SIZE, before any of it is read. Multipart bodies
+        are left to django's upload handlers, which don't hold files in
+        memory.
+        
+        """
+        max_size = getattr(settings, 'SPROUTCORE_MAX_BODY_SIZE',
+            self.max_body_size)
+        if max_size is None or parse_media_type(request.META.get(
+            'CONTENT_TYPE', ''))[0].startswith('multipart/'):
+            return
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if length > max_size:
+            raise BodyTooLarge("The request body is larger than %d bytes"
+                % max_size)
+
     def translate(self, request):
         """
         Looks at the ``Content-type`` header sent by the client, and
@@ -87,36 +164,44 @@ class Mimer(object):
         ``request.data`` since it is not necessarily a simple list of
         key-value pairs.
         
-        Also sets ``request.content_type``. ``request.content_type``
-        will be set to None for form-encoded or multipart form data.
+        Also sets ``request.content_type`` to the media type of the body.
+        ``request.content_type`` will be set to None for form-encoded or
+        multipart form data.
+        
+        Raises BodyTooLarge for bodies larger than SPROUTCORE_MAX_BODY_SIZE.
         
         """    
         ctype = self.content_type(request)
         request.content_type = ctype
         request.data = None
-
-        # For PUT requests we have to force django to load the request data.
-        if request.method == "PUT":
-            try:
-                request.method = "POST"
-                request._load_post_and_files()
-                request.method = "PUT"
-            except AttributeError:
-                request.META['REQUEST_METHOD'] = "POST"
-                request._load_post_and_files()
-                request.META['REQUEST_METHOD'] = "PUT"
+        self.check_body_size(request)
                 
         if ctype:
             mimer = self.mimer_for_ctype(ctype)
             if mimer:
                 try:
-                    request.data = mimer(request.raw_post_data)
+                    if ctype in self._streams:
+                        # Read the body straight from the input stream,
+                        # instead of having django copy it into raw_post_data.
+                        request.data = mimer(request)
+                    else:
+                        request.data = mimer(request.raw_post_data)
                         
                 except (TypeError, ValueError):
                     raise MalformedData("The '%s' data sent in the request was "
                       "malformed" % ctype)
         
         elif request.method in ("PUT", "POST"):
+            # For PUT requests we have to force django to load the form data.
+            if request.method == "PUT":
+                try:
+                    request.method = "POST"
+                    request._load_post_and_files()
+                    request.method = "PUT"
+                except AttributeError:
+                    request.META['REQUEST_METHOD'] = "POST"
+                    request._load_post_and_files()
+                    request.META['REQUEST_METHOD'] = "PUT"
             # The data for PUT requests still resides in the POST variable,
             # since we tricked django into loading it as POST data.
             request.data = request.POST
@@ -126,25 +211,148 @@ class Mimer(object):
         
         return request
 
+def parse_accept(header):
+    """
+    Parses an ``Accept`` or ``Accept-Encoding`` header into a list of its
+    lowercased values, best first. Values with a quality of 0 are dropped;
+    values of equal quality keep the order of the header.
+    
+    """
+    values = []
+    for i, part in enumerate(header.split(',')):
+        params = part.split(';')
+        value = params[0].strip().lower()
+        if not value:
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            name, _, q = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(q)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            values.append((-quality, i, value))
+    values.sort()
+    return [value for quality, i, value in values]
+
 class Emitter(object):
+    default_format = 'json'
+
     def __init__(self):
         self._registry = {}
+        self._streams = {}
+        self._pretty = {}
+        self._incremental = set()
+        # Negotiated formats and encodings, keyed by the header they were
+        # negotiated from. Clients send the same few headers over and over.
+        self._negotiated = LRUCache(256)
 
-    def register(self, format, emitter, ctype):
+    def register(self, format, emitter, ctype, stream=None, pretty=None,
+        incremental=False):
+        """
+        Registers an emitter function for a format. The optional stream
+        function takes an iterable of items and a ``pretty`` flag, and yields
+        the serialized response in chunks; formats without one are
+        serialized at once. The optional pretty function is used instead of
+        the emitter for human readers. The emitter of an ``incremental``
+        format yields its output in chunks as well, which are sent like a
+        stream.
+        
+        """
         if format in self._registry:
             raise AlreadyRegistered("The emitter for %s is already registered"
               % format)
         self._registry[format] = (emitter, ctype)
+        if stream:
+            self._streams[format] = stream
+        if pretty:
+            self._pretty[format] = pretty
+        if incremental:
+            self._incremental.add(format)
+        self._negotiated.clear()
         
     def unregister(self, format):
         if format not in self._registry:
             raise NotRegistered("The emitter for %s is not registered" % format)
         del self._registry[format]
+        self._streams.pop(format, None)
+        self._pretty.pop(format, None)
+        self._incremental.discard(format)
+        self._negotiated.clear()
     
     def emitter_for_format(self, format):
         return self._registry.get(format, (None, None))
+
+    def stream_for_format(self, format):
+        return self._streams.get(format, None)
+
+    def format_for_accept(self, accept):
+        """
+        Returns the registered format that best matches an ``Accept`` header.
+        Falls back to the default format for wildcards, for missing headers,
+        and for headers that only list types no emitter produces.
+        
+        """
+        if not accept:
+            return self.default_format
+        key = 'accept:' + accept
+        format = self._negotiated.get(key)
+        if format is None:
+            formats = {}
+            for name, (emitter, ctype) in self._registry.items():
+                formats[ctype.split(';')[0].strip().lower()] = name
+            format = self.default_format
+            for mtype in parse_accept(accept):
+                if mtype in formats:
+                    format = formats[mtype]
+                    break
+                if mtype == '*/*':
+                    break
+                if mtype.endswith('/*'):
+                    matches = sorted([name for ctype, name in formats.items()
+                        if ctype.startswith(mtype[:-1])])
+                    if matches:
+                        if self.default_format not in matches:
+                            format = matches[0]
+                        break
+            self._negotiated.set(key, format)
+        return format
+
+    def encoding_for_accept(self, accept_encoding):
+        """
+        Returns the content coding, 'gzip' or 'deflate', that best matches an
+        ``Accept-Encoding`` header, or None if the body should be sent as is.
+        
+        """
+        if not accept_encoding:
+            return None
+        key = 'encoding:' + accept_encoding
+        encoding = self._negotiated.get(key)
+        if encoding is None:
+            encoding = ''
+            for coding in parse_accept(accept_encoding):
+                if coding in ('gzip', 'x-gzip', '*'):
+                    encoding = 'gzip'
+                    break
+                if coding == 'deflate':
+                    encoding = 'deflate'
+                    break
+                if coding == 'identity':
+                    break
+            self._negotiated.set(key, encoding)
+        return encoding or None
                     
-    def translate(self, format, response):
+    def translate(self, format, response, pretty=False, encoding=None,
+        min_size=0):
+        """
+        Serializes the response in the given format. If an ``encoding`` is
+        given, bodies of at least ``min_size`` bytes, and all streamed
+        bodies, are compressed with it. Bodies of incremental formats are
+        read up to ``min_size`` bytes to tell.
+        
+        """
         # We catch and return any HttpResponses here for convenience's sake.
         # This really should be the developers responsibility
         if isinstance(response, HttpResponse):
@@ -158,65 +366,237 @@ class Emitter(object):
             if settings.DEBUG:
                 ctype = 'text/plain; charset=utf-8'
 
+            # Responses are compact, unless they are read by a developer.
+            pretty = pretty or settings.DEBUG or \
+                getattr(settings, 'SPROUTCORE_JSON_PRETTY', False)
+            if pretty:
+                emitter = self._pretty.get(format, emitter)
+
             ops = {'content_type': ctype}            
+            streaming = isinstance(response, StreamableResponse)
             if isinstance(response, EmittableResponse):
                 ops.update(response.ops)
                 response = response.content
+
+            if streaming:
+                # HttpResponse sends iterators chunk by chunk, as the WSGI
+                # server consumes them.
+                stream = self.stream_for_format(format)
+                if stream:
+                    content = stream(response, pretty)
+                    if encoding:
+                        content = compress_stream(content, encoding)
+                    return encode_response(HttpResponse(content, **ops),
+                        encoding)
+                response = list(response)
             
             # Deconstruct the response, serializer it, and then create a new
             # HttpResponse with the given options specified.
-            response = deconstruct(response)
-            return HttpResponse((response), **ops)
+            content = emitter(deconstruct(response))
+            if format in self._incremental:
+                if encoding:
+                    head, rest = read_chunks(content, min_size)
+                    if rest is None:
+                        # The whole body is shorter than min_size.
+                        content = ''.join(head)
+                        encoding = None
+                    else:
+                        content = compress_stream(chain(head, rest), encoding)
+                return encode_response(HttpResponse(content, **ops), encoding)
+            if encoding:
+                content = smart_str(content)
+                if len(content) >= min_size:
+                    content = compress_string(content, encoding)
+                else:
+                    encoding = None
+            response = encode_response(HttpResponse(content, **ops), encoding)
+            if encoding:
+                response['Content-Length'] = str(len(content))
+            return response
         return HttpResponseBadRequest("Cannot to serialize response to '%s' "
             "format specified in request" % format)        
     
+def compressor(encoding):
+    # gzip is deflate with a gzip header and trailer, which zlib writes when
+    # 16 is added to the window size. HTTP's deflate has a zlib header.
+    if encoding == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(6)
+
+def compress_string(content, encoding):
+    compress = compressor(encoding)
+    return compress.compress(content) + compress.flush()
+
+def compress_stream(chunks, encoding):
+    """Compresses the chunks of a streamed body, without holding them back."""
+    compress = compressor(encoding)
+    for chunk in chunks:
+        yield compress.compress(smart_str(chunk)) + \
+            compress.flush(zlib.Z_SYNC_FLUSH)
+    yield compress.flush()
+
+def read_chunks(chunks, min_size):
+    """
+    Reads the chunks of a body until they add up to at least ``min_size``
+    bytes. Returns the chunks read and an iterator over the remaining ones,
+    or None instead of the iterator if the body ended before.
+    
+    """
+    chunks = iter(chunks)
+    head, size = [], 0
+    for chunk in chunks:
+        chunk = smart_str(chunk)
+        head.append(chunk)
+        size += len(chunk)
+        if size >= min_size:
+            return head, chunks
+    return head, None
+
+def encode_response(response, encoding):
+    if encoding:
+        response['Content-Encoding'] = encoding
+    return response
+
 mimer = Mimer()
 emitter = Emitter()
 
-#add different json types as returned by browser-tests. mabye splitting at ';'
-#could make more sense
-#TODO: split the ctype, set to lowercase
-mimer.register(('application/json', 'application/json; charset=UTF-8',
-    'application/json; charset=utf-8'), lambda s: simplejson.loads(s))
-emitter.register('json', lambda s: simplejson.dumps(s,
-    cls=DjangoJSONEncoder, ensure_ascii=False, indent=4),
-    'application/json; charset=utf-8')
+mimer.register('application/json', lambda request: simplejson.load(request),
+    stream=True)
+
+def dump_json(data, pretty=False):
+    """
+    The default JSON encoder. Writes compact JSON, or indented JSON if
+    ``pretty`` is set.
+    
+    """
+    if pretty:
+        return simplejson.dumps(data, cls=DjangoJSONEncoder,
+            ensure_ascii=False, indent=4)
+    return simplejson.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False,
+        separators=(',', ':'))
+
+def load_json_encoder(path):
+    """Imports the encoder function with the given dotted path."""
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)
+
+# The JSON encoder is selected once, at startup. SPROUTCORE_JSON_ENCODER can
+# name another function with the signature of dump_json, i.e. one that uses a
+# faster JSON library.
+json_encoder = dump_json
+if getattr(settings, 'SPROUTCORE_JSON_ENCODER', None):
+    json_encoder = load_json_encoder(settings.SPROUTCORE_JSON_ENCODER)
+
+def stream_json(items, pretty=False, chunk_size=100):
+    """Yields a JSON list of the items, in chunks of ``chunk_size`` items."""
+    chunk = []
+    separator = '['
+    for item in items:
+        chunk.append(separator)
+        chunk.append(json_encoder(deconstruct(item), pretty))
+        separator = ','
+        if len(chunk) >= chunk_size * 2:
+            yield u''.join(chunk)
+            chunk = []
+    if separator == '[':
+        chunk.append(separator)
+    chunk.append(']')
+    yield u''.join(chunk)
+
+emitter.register('json', lambda s: json_encoder(s),
+    'application/json; charset=utf-8', stream=stream_json,
+    pretty=lambda s: json_encoder(s, pretty=True))
 
 if yaml:
+    # safe_dump looks representers up by exact type, so the lists of the row
+    # serializers need their own.
+    yaml.SafeDumper.add_representer(PrimitiveList,
+        yaml.SafeDumper.represent_list)
+
     # YAML doesn't have an official mimetype, so we go with the common ones.
     mimer.register(('text/yaml', 'text/x-yaml', 'application/yaml', 
         'application/x-yaml'), lambda s: dict(yaml.load(s)))
     emitter.register('yaml', lambda s: yaml.safe_dump(s),
         'text/x-yaml; charset=utf-8')
 
-def dump_xml(data):
-    """Simple function to convert python data structures to xml."""
+if msgpack:
+    # Dates, times and decimals are converted the way DjangoJSONEncoder does.
+    # Strings are sent as msgpack strings, never as binary.
+    def dump_msgpack(data):
+        return msgpack.packb(data, default=DjangoJSONEncoder().default,
+            use_bin_type=False)
+
+    if msgpack.version >= (0, 5, 2):
+        def load_msgpack(data):
+            return msgpack.unpackb(data, raw=False)
+    else:
+        def load_msgpack(data):
+            return msgpack.unpackb(data, encoding='utf-8')
+
+    mimer.register(('application/x-msgpack', 'application/msgpack'),
+        load_msgpack)
+    emitter.register('msgpack', dump_msgpack, 'application/x-msgpack')
+
+def iter_xml(data, chunk_size=100):
+    """
+    Converts python data structures to xml, and yields the document in
+    chunks. A chunk is yielded every ``chunk_size`` resources, however deep
+    the lists are nested, i.e. in {records, total} pages, so only one chunk
+    of the document is held in memory at a time.
+    
+    """
     def _to_xml(xml, data):
-        if isinstance(data, dict):
-            for key, value in data.iteritems():
-                key = force_unicode(key)
-                xml.startElement(key, {})
-                _to_xml(xml, value)
-                xml.endElement(key)
-        elif hasattr(data, '__iter__'):
-            for item in data:
-                xml.startElement("resource", {})
-                _to_xml(xml, item)
-                xml.endElement("resource")
+        # Only containers are generators, since there are far more scalars.
+        resources = not isinstance(data, dict)
+        if resources:
+            children = (("resource", item) for item in data)
         else:
-            xml.characters(force_unicode(data))
+            children = [(force_unicode(k), v) for k, v in data.iteritems()]
+        for name, value in children:
+            xml.startElement(name, {})
+            if hasattr(value, '__iter__'):
+                for chunk in _to_xml(xml, value):
+                    yield chunk
+            else:
+                xml.characters(force_unicode(value))
+            xml.endElement(name)
+            if resources:
+                written[0] += 1
+                if written[0] % chunk_size == 0:
+                    yield flush()
+
+    def flush():
+        chunk = stream.getvalue()
+        stream.seek(0)
+        stream.truncate()
+        return chunk
 
     stream = StringIO.StringIO()
+    written = [0] # the number of resources written so far
     
     xml = SimplerXMLGenerator(stream, "utf-8")
     xml.startDocument()
     xml.startElement("response", {})
     
-    _to_xml(xml, data)
+    if hasattr(data, '__iter__'):
+        for chunk in _to_xml(xml, data):
+            yield chunk
+    else:
+        xml.characters(force_unicode(data))
     
     xml.endElement("response")
     xml.endDocument()
     
-    return stream.getvalue()
+    yield flush()
+
+def dump_xml(data):
+    """Simple function to convert python data structures to xml."""
+    return ''.join(iter_xml(data))
+
+def stream_xml(items, pretty=False, chunk_size=100):
+    """Yields an xml document of the items, in chunks of ``chunk_size``
+    items."""
+    return iter_xml((deconstruct(item) for item in items), chunk_size)
 
-emitter.register('xml', lambda s: dump_xml(s), 'text/xml; charset=utf-8')
\ No newline at end of file
+emitter.register('xml', iter_xml, 'text/xml; charset=utf-8',
+    stream=stream_xml, incremental=True)
\ No newline at end of file
@@ -1,3 +1,24 @@
 {% autoescape off %}
 {{ app_label }} = SC.Object.create();
-{% endautoescape %}
\ No newline at end of file
+
+/**
+  Decodes records that were requested with ?layout=columns, i.e.
+
+    [{"model": "polls.choice", "columns": ["pk", "answer"]}, [1, "Blue"]]
+
+  back into the {pk: ..., model: ..., fields: {...}} records of the default
+  layout. Lists that already hold records are returned as they are.
+*/
+{{ app_label }}.decodeRecords = function(records) {
+  var header = records && records[0], columns, decoded = [], row, fields, i, j;
+  if (!header || !header.columns) return records;
+  columns = header.columns;
+  for (i = 1; i < records.length; i++) {
+    row = records[i];
+    fields = {};
+    for (j = 1; j < columns.length; j++) fields[columns[j]] = row[j];
+    decoded.push({pk: row[0], model: header.model, fields: fields});
+  }
+  return decoded;
+};
+{% endautoescape %}
@@ -1,16 +1,28 @@
 import re
 import decimal
+import datetime
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from django.utils.datastructures import SortedDict as OrderedDict
 
 from django.utils.encoding import force_unicode
 
-def deconstruct(item):
+class PrimitiveList(list):
     """
-    Recursively loops through the item's children, converting them all
-    to python types, falling back to calling Django's `force_unicode`.
-
+    A list of items that only contain python primitives (dicts, lists,
+    unicode strings, numbers, booleans, None and dates) already, as built by
+    serializers that convert their values themselves. ``deconstruct`` passes
+    it through without walking it.
+    
     """
+    pass
+
+def _deconstruct_other(item):
     if isinstance(item, dict):
-        return dict([(k, deconstruct(v)) for k, v in item.iteritems()])
+        return _deconstruct_dict(item)
     elif isinstance(item, decimal.Decimal):
         return str(item)
     elif hasattr(item, '__iter__'):
@@ -19,6 +31,44 @@ def deconstruct(item):
         return None
     else:
         return force_unicode(item, strings_only=True)
+
+def _deconstruct_dict(item):
+    return dict([(k, deconstruct(v)) for k, v in item.iteritems()])
+
+def _deconstruct_list(item):
+    return [deconstruct(v) for v in item]
+
+def _unchanged(item):
+    return item
+
+# Maps exact types to the function that deconstructs them, so that the common
+# types skip the isinstance checks. Everything else (subclasses included)
+# goes through ``_deconstruct_other``.
+_deconstructors = {
+    unicode: _unchanged,
+    str: force_unicode,
+    int: _unchanged,
+    long: _unchanged,
+    float: _unchanged,
+    bool: _unchanged,
+    type(None): _unchanged,
+    datetime.datetime: _unchanged,
+    datetime.date: _unchanged,
+    datetime.time: _unchanged,
+    decimal.Decimal: str,
+    dict: _deconstruct_dict,
+    list: _deconstruct_list,
+    tuple: _deconstruct_list,
+    PrimitiveList: _unchanged,
+}
+
+def deconstruct(item):
+    """
+    Recursively loops through the item's children, converting them all
+    to python types, falling back to calling Django's `force_unicode`.
+
+    """
+    return _deconstructors.get(type(item), _deconstruct_other)(item)
  
 def camelize(string):
     """
@@ -73,7 +123,79 @@ def splitwords(string):
             uncam.append(' ')
         uncam.append(c)
     return ''.join(uncam).strip()
-    
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe mapping that discards the least recently used
+    entry once ``max_size`` entries are stored.
+
+    Hits, misses and evictions are counted so that the cache can be sized
+    from real traffic; see ``stats``.
+
+    """
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Re-insert the entry so that it becomes the most recently used.
+            self._data[key] = value
+            self.hits += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                del self._data[iter(self._data).next()]
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def stats(self):
+        """Returns the cache counters as a dictionary."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._data),
+            'max_size': self.max_size,
+        }
+
+
 
 
 
@@ -1,7 +1,34 @@
 # coding: utf-8
+import datetime
+import decimal
+import time
+import zlib
 
+from django.db.models import Q
 from django.test import Client, TestCase
-from polls.models import Poll
+from django.test.client import RequestFactory
+from polls.models import Poll, Choice
+from polls import api # Registers the resources used below.
+from django.utils import simplejson
+from djangocore.api import site
+from django.utils.unittest import skipUnless
+from djangocore.serialization import stream_json, dump_json, \
+    load_json_encoder, msgpack, yaml, emitter, parse_accept, iter_xml, dump_xml, \
+    mimer, parse_media_type
+if msgpack:
+    from djangocore.serialization import dump_msgpack, load_msgpack
+from djangocore.api.models.query_translator import translator, \
+    datastore_compiler, QueryError
+from djangocore.api.models.query_cost import QueryCostPolicy, QueryCostError, \
+    QueryCost
+from djangocore.api.models.named_query import NamedQuery
+from djangocore.api.models.keyset import Keyset
+from djangocore.api.models.count_cache import CountCache, DjangoCountCache
+from djangocore.api.models.count_estimate import CountEstimator, timed_count
+from djangocore.api.models.relation_plan import RelationPlanner
+from djangocore.api.models.row_serializer import RowSerializer
+from djangocore.utils import deconstruct, PrimitiveList
+from django.core.serializers import serialize
 
 from django.test.client import urlparse, urllib, settings, FakePayload, \
     encode_multipart, MULTIPART_CONTENT, CONTENT_TYPE_RE, BOUNDARY
@@ -57,6 +84,47 @@ class PollResourceTest(TestCase):
         response = self.client.get('/api/models/polls/poll/list/')
         self.assertContains(response, 'What color are your socks?')
 
+    def test_list_view_with_malformed_conditions(self):
+        response = self.client.get('/api/models/polls/choice/list/',
+            {'conditions': "answer = 'Blue' OR"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_list_view_with_invalid_parameter(self):
+        response = self.client.get('/api/models/polls/choice/list/',
+            {'conditions': "votes = {v}", 'parameters': 'v=many'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_list_view_with_json_parameters(self):
+        response = self.client.get('/api/models/polls/choice/length/',
+            {'conditions': "pk ANY {ids}", 'parameters': '{"ids": [1, 2, 9]}'})
+        self.assertEqual(response.content, '2')
+
+    def test_posted_query(self):
+        json_data = """
+        {
+            "conditions": "pk ANY {ids} AND answer != {answer}",
+            "parameters": {"ids": [1, 2, 3], "answer": "Red"}
+        }
+        """
+        response = self.client.post('/api/models/polls/choice/length/',
+            json_data, content_type='application/json')
+        self.assertEqual(response.content, '2')
+
+    def test_posted_option_types(self):
+        def post(data):
+            return self.client.post('/api/models/polls/choice/list/',
+                simplejson.dumps(data), content_type='application/json')
+        response = self.client.get('/api/models/polls/choice/list/',
+            {'fields': 'answer,votes', 'ordering': '-votes,answer',
+            'with_total': 'true'})
+        self.assertEqual(post({'fields': ['answer', 'votes'], 'with_total': True,
+            'ordering': ['-votes', 'answer']}).content, response.content)
+        self.assertTrue(isinstance(simplejson.loads(
+            post({'with_total': False}).content), list))
+        for data in ({'conditions': 1}, {'conditions': ["answer = 'Red'"]},
+            {'stream': 1}, {'fields': ['answer', 1]}, {'ordering': {'a': 1}}):
+            self.assertEqual(post(data).status_code, 400)
+
     def test_show_view(self):
         response = self.client.get('/api/models/polls/poll/?pk=1')
         self.assertContains(response, 'What color are your socks?')
@@ -98,3 +166,937 @@ class PollResourceTest(TestCase):
         self.assertEqual(response.content, '')
         self.assertEqual(response.status_code, 204)
         self.assertEqual(Poll.objects.count(), count - 1)
+
+class QueryTranslatorTest(TestCase):
+    fixtures = ['testdata']
+
+    def test_compiled_plan_is_cached(self):
+        t = translator()
+        t.parse("answer = {a}", {'a': 'Blue'})
+        t.parse("answer  =   {a}", {'a': 'Red'})
+        stats = t.cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+
+    def test_parameters_are_bound_per_request(self):
+        t = translator()
+        q = t.parse("answer = {a}", {'a': 'Blue'})
+        self.assertEqual(Choice.objects.filter(q).get().pk, 1)
+        q = t.parse("answer = {a}", {'a': 'Red'})
+        self.assertEqual(Choice.objects.filter(q).get().pk, 2)
+
+    def answers(self, query, parameters={}):
+        q = translator().parse(query, parameters)
+        return sorted(Choice.objects.filter(q).values_list('answer', flat=True))
+
+    def test_and_binds_tighter_than_or(self):
+        self.assertEqual(self.answers(
+            "answer = 'Blue' OR answer = 'Red' AND votes = 1"), ['Blue'])
+        self.assertEqual(self.answers(
+            "(answer = 'Blue' OR answer = 'Red') AND votes = 0"), ['Blue', 'Red'])
+
+    def test_not(self):
+        self.assertEqual(self.answers(
+            "NOT (answer = 'Blue' OR answer = 'Red')"), ['Gray', 'Green', 'White'])
+        self.assertEqual(self.answers(
+            "answer NOT BEGINS_WITH 'G' AND answer != 'Red'"), ['Blue', 'White'])
+
+    def test_any_and_in(self):
+        self.assertEqual(self.answers("answer ANY {colors}",
+            {'colors': ['Red', 'Gray']}), ['Gray', 'Red'])
+        self.assertEqual(self.answers("pk IN (1, 2)"), ['Blue', 'Red'])
+        self.assertEqual(self.answers("pk NOT IN [1, 2, 3]"), ['Gray', 'White'])
+
+    def test_large_any_sets_are_chunked(self):
+        t = translator(Choice, in_chunk_size=2)
+        q = t.parse("pk ANY {ids}", {'ids': ['1', 2, 3, 3, 4, 5, 6]})
+        self.assertEqual(q.connector, Q.OR)
+        self.assertEqual(len(q.children), 3)
+        self.assertEqual(Choice.objects.filter(q).count(), 5)
+
+    def test_missing_parameter(self):
+        self.assertRaises(QueryError, translator().parse, "answer = {a}", {})
+
+    def test_pathological_inputs_are_rejected(self):
+        corpus = [
+            "answer = 'unterminated",
+            "'" * 5001,
+            "AND " * 1000,
+            "answer =",
+            "= 1",
+            "(answer = 1",
+            "answer = 1)",
+            "answer = (1, 2",
+            "answer = 1 AND AND votes = 2",
+            "answer BEGINS_WITH",
+            "answer = {}",
+            "answer = 1 " + "OR " * 1000,
+            "answer = 1 votes = 2",
+            "answer TYPE_IS 'Choice'",
+            "answer = 1 ; DROP TABLE polls_choice",
+            "(" * 1000 + "answer = 1" + ")" * 1000,
+            "NOT " * 1000 + "answer = 1",
+            "answer = " + "(" * 1000,
+            "answer = ('Red', 'Blue')",
+            "'" + "\\'" * 20000,
+        ]
+        t = translator()
+        for query in corpus:
+            self.assertRaises(QueryError, t.compile, query)
+
+    def test_long_queries_parse_in_linear_time(self):
+        t = translator()
+        clause = "(answer = 'a b c' OR votes >= {v}) AND NOT answer CONTAINS 'x'"
+        query = " AND ".join([clause] * 5000)
+        start = time.time()
+        t.compile(query)
+        self.assertTrue(time.time() - start < 2)
+
+    def test_unterminated_strings_are_rejected_in_linear_time(self):
+        t = translator()
+        start = time.time()
+        self.assertRaises(QueryError, t.compile, "'" + "\\'" * 200000)
+        self.assertTrue(time.time() - start < 2)
+
+    def test_long_queries_are_rejected(self):
+        t = translator(max_length=20)
+        self.assertEqual(t.compile("votes = 0").operator, "=")
+        self.assertRaises(QueryError, t.compile, "votes = 0 AND votes = 1")
+
+    def test_literals_are_coerced_to_the_field_type(self):
+        t = translator(Choice)
+        tree = t.compile("votes = '0' AND poll ANY ('1', 2) AND answer = 3")
+        self.assertEqual([c.value.value for c in tree.children[::2]], [0, u'3'])
+        self.assertEqual([v.value for v in tree.children[1].value], [1, 2])
+        self.assertEqual(Choice.objects.filter(t.bind(tree)).count(), 0)
+
+    def test_parameters_are_coerced_to_the_field_type(self):
+        t = translator(Choice)
+        q = t.parse("votes = {v} AND poll.slug = {s}", {'v': u'0', 's': 'sock-color'})
+        self.assertEqual(Choice.objects.filter(q).count(), 5)
+
+    def test_invalid_values_are_rejected(self):
+        t = translator(Choice)
+        self.assertRaises(QueryError, t.compile, "votes = 'many'")
+        self.assertRaises(QueryError, t.parse, "votes > {v}", {'v': 'many'})
+
+    def test_reverse_and_django_paths_are_coerced(self):
+        self.assertRaises(QueryError, translator(Poll).compile,
+            "choice.votes = 'many'")
+        self.assertRaises(QueryError, translator(Choice).compile,
+            "poll__id = 'abc'")
+        q = translator(Poll).parse("choice.votes = '0'")
+        self.assertEqual(Poll.objects.filter(q).distinct().count(), 1)
+        for path, query in (('poll', "choice.votes = 'many'"),
+            ('choice', "poll__id = 'abc'")):
+            response = self.client.get('/api/models/polls/%s/length/' % path,
+                {'conditions': query})
+            self.assertEqual(response.status_code, 400)
+        # Plain lookups skip the translator, so the resource catches them.
+        response = self.client.get('/api/models/polls/choice/length/',
+            {'votes': 'many'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/models/polls/choice/length/',
+            '{"votes": {"many": 1}}', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_lists_are_only_compared_with_any(self):
+        for t in (translator(), translator(Choice)):
+            for query in ("answer = {a}", "votes > {a}", "answer CONTAINS {a}"):
+                self.assertRaises(QueryError, t.parse, query,
+                    {'a': ['Red', 'Blue']})
+            self.assertEqual(len(Choice.objects.filter(
+                t.parse("answer ANY {a}", {'a': ['Red', 'Blue']}))), 2)
+
+    def test_cache_evicts_least_recently_used(self):
+        t = translator(cache_size=2)
+        for query in ("votes = 0", "votes = 1", "votes = 0", "votes = 2"):
+            t.parse(query)
+        self.assertEqual(t.cache.stats()['evictions'], 1)
+        self.assertTrue("votes = 0" in t.cache)
+        self.assertFalse("votes = 1" in t.cache)
+
+class QueryCostPolicyTest(TestCase):
+    fixtures = ['testdata']
+
+    def setUp(self):
+        self.resource = site._registry['models/polls/choice/']
+
+    def tearDown(self):
+        self.resource.cost_policy = None
+
+    def test_inspect_conditions(self):
+        plan = translator().compile(
+            "poll.question CONTAINS 'x' AND answer MATCHES {r} AND pk = 1")
+        cost = QueryCostPolicy().inspect(Choice, plan)
+        self.assertEqual(cost.joins, set(['poll']))
+        self.assertEqual((cost.unanchored, cost.regex), (1, 1))
+        self.assertEqual(cost.unindexed, ['poll.question', 'answer'])
+
+    def test_inspect_lookups(self):
+        cost = QueryCostPolicy().inspect(Choice,
+            lookups={'poll__slug__endswith': 'x', 'votes__gt': 1})
+        self.assertEqual(cost.joins, set(['poll']))
+        self.assertEqual(cost.unanchored, 1)
+        self.assertEqual(cost.unindexed, ['votes'])
+
+    def test_django_paths_in_conditions(self):
+        policy = QueryCostPolicy(max_joins=0, allow_unindexed=False)
+        for query in ("poll.question = 'x'", "poll__question = 'x'",
+            "poll__question CONTAINS 'x'"):
+            cost = policy.inspect(Choice, translator().compile(query))
+            self.assertEqual(cost.joins, set(['poll']))
+            self.assertEqual(cost.unindexed, ['poll.question'])
+            self.assertRaises(QueryCostError, policy.evaluate, self.resource,
+                translator().compile(query))
+
+    def test_reject(self):
+        policy = QueryCostPolicy(allow_unanchored=False)
+        plan = translator().compile("answer ENDS_WITH 'e'")
+        self.assertRaises(QueryCostError, policy.evaluate, self.resource, plan)
+
+        self.resource.cost_policy = policy
+        response = self.client.get('/api/models/polls/choice/list/',
+            {'conditions': "answer CONTAINS 'e'"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_limit(self):
+        self.resource.cost_policy = QueryCostPolicy(max_joins=0,
+            action='limit', limit=2)
+        response = self.client.get('/api/models/polls/choice/length/',
+            {'conditions': "poll.slug = 'sock-color'"})
+        self.assertEqual(simplejson.loads(response.content),
+            {'count': 2, 'exact': False})
+        response = self.client.get('/api/models/polls/choice/length/',
+            {'conditions': "poll.slug = 'sock-color' AND votes > 0"})
+        self.assertEqual(simplejson.loads(response.content),
+            {'count': 0, 'exact': True})
+        response = self.client.get('/api/models/polls/choice/length/',
+            {'conditions': "poll = 1"})
+        self.assertEqual(response.content, '5')
+
+class NamedQueryTest(TestCase):
+    fixtures = ['testdata']
+
+    def setUp(self):
+        self.resource = site._registry['models/polls/choice/']
+        self.resource.compiled_queries = {}
+        for name, query in {
+            'by_answer': NamedQuery("poll = {poll} AND answer ANY {answers}",
+                poll=int, answers=lambda s: s.split(';')),
+            'popular': NamedQuery(lambda min: Q(votes__gte=min), min=int),
+        }.items():
+            self.resource.compiled_queries[name] = \
+                (query, query.compile(self.resource.translator))
+
+    def tearDown(self):
+        self.resource.compiled_queries = {}
+
+    def length(self, **params):
+        return self.client.get('/api/models/polls/choice/length/', params)
+
+    def test_named_queries(self):
+        self.assertEqual(self.length(query='by_answer', poll='1',
+            answers='Red;Blue').content, '2')
+        self.assertEqual(self.length(query='popular', min='1').content, '0')
+
+    def test_bad_requests(self):
+        self.assertEqual(self.length(query='unknown').status_code, 400)
+        self.assertEqual(self.length(query='popular').status_code, 400)
+        self.assertEqual(self.length(query='popular', min='x').status_code, 400)
+        self.assertEqual(self.length(query='popular', min='1',
+            votes='1').status_code, 400)
+
+    def test_undeclared_parameters(self):
+        query = NamedQuery("votes = {votes}")
+        self.assertRaises(TypeError, query.compile, translator(Choice))
+
+class DatastoreCompilerTest(TestCase):
+    def setUp(self):
+        self.compiler = datastore_compiler(translator())
+
+    def filters(self, query, parameters={}):
+        return self.compiler.compile(self.compiler.translator.compile(query),
+            parameters)
+
+    def test_filters(self):
+        self.assertEqual(self.filters("votes >= {min} AND answer = 'Red'",
+            {'min': 3}), [("votes >=", 3), ("answer =", u"Red")])
+        self.assertEqual(self.filters("answer = 'Red' OR answer = 'Blue'"),
+            [("answer IN", [u"Red", u"Blue"])])
+        self.assertEqual(self.filters("NOT votes < 3"), [("votes >=", 3)])
+        self.assertEqual(self.filters("answer BEGINS_WITH 'Re'"),
+            [("answer >=", u"Re"), ("answer <", u"Re\ufffd")])
+        self.assertEqual(self.filters("pk ANY {pks}", {'pks': [1, 2]}),
+            [("__key__ IN", [1, 2])])
+
+    def test_orders(self):
+        filters = self.filters("answer = 'Red' AND votes > 1")
+        self.assertEqual(self.compiler.orders(filters, ['-answer']),
+            ['votes', '-answer'])
+        self.assertEqual(self.compiler.orders([("answer =", u"Red")], ['answer']),
+            ['answer'])
+        # Plain lookups compare for equality.
+        self.assertEqual(self.compiler.orders([("answer", u"Red"),
+            ("votes >", 1)]), ['votes'])
+
+    def test_unsupported_queries(self):
+        for query in ("answer CONTAINS 'e'", "answer = 'Red' OR votes = 1",
+            "poll.slug = 'sock-color'", "votes > 1 AND answer < 'B'",
+            "NOT (votes = 1 AND answer = 'Red')", "votes = pk"):
+            plan = self.compiler.translator.compile(query)
+            self.assertTrue(self.compiler.problems(plan), query)
+            self.assertRaises(QueryError, self.compiler.compile, plan)
+
+class CursorPaginationTest(TestCase):
+    fixtures = ['testdata']
+
+    def setUp(self):
+        self.resource = site._registry['models/polls/choice/']
+
+    def page(self, **params):
+        request = RequestFactory().get('/api/models/polls/choice/list/', params)
+        return self.resource.list(request)
+
+    def answers(self, page):
+        return [record['fields']['answer'] for record in page['records']]
+
+    def test_pages(self):
+        Choice.objects.filter(pk__in=[2, 4]).update(votes=3)
+        first = self.page(cursor='', ordering='-votes', limit='3')
+        self.assertEqual(self.answers(first), ['Red', 'White', 'Blue'])
+        self.assertTrue(first['has_more'])
+
+        second = self.page(cursor=first['cursor'], ordering='-votes', limit='3')
+        self.assertEqual(self.answers(second), ['Green', 'Gray'])
+        self.assertFalse(second['has_more'])
+
+    def test_conditions(self):
+        page = self.page(cursor='', ordering='answer', limit='2',
+            conditions="answer != 'Blue'")
+        page = self.page(cursor=page['cursor'], ordering='answer', limit='2',
+            conditions="answer != 'Blue'")
+        self.assertEqual(self.answers(page), ['Red', 'White'])
+        self.assertFalse(page['has_more'])
+
+    def test_foreign_key_ordering(self):
+        keyset = Keyset(translator(Choice), ['poll'])
+        choice = Choice.objects.get(pk=3)
+        self.assertNumQueries(0, keyset.encode, choice)
+        first = self.page(cursor='', ordering='poll', limit='3')
+        second = self.page(cursor=first['cursor'], ordering='poll', limit='3')
+        self.assertEqual([r['pk'] for r in first['records'] + second['records']],
+            [1, 2, 3, 4, 5])
+
+    def test_invalid_cursors(self):
+        cursor = self.page(cursor='', ordering='answer', limit='1')['cursor']
+        self.assertEqual(self.page(cursor=cursor, ordering='votes').ops['status'], 400)
+        self.assertEqual(self.page(cursor='garbage!').ops['status'], 400)
+
+class ListWithTotalTest(TestCase):
+    fixtures = ['testdata']
+
+    def setUp(self):
+        self.resource = site._registry['models/polls/choice/']
+
+    def list(self, **params):
+        request = RequestFactory().get('/api/models/polls/choice/list/', params)
+        return self.resource.list(request)
+
+    def test_total(self):
+        for window_count in (True, False):
+            self.resource.window_count = window_count
+            page = self.list(with_total='1', ordering='answer', limit='2',
+                conditions="answer != 'Blue'")
+            self.assertEqual(len(page['records']), 2)
+            self.assertEqual(page['total'], 4)
+        self.resource.window_count = True
+
+    def test_total_past_the_last_page(self):
+        page = self.list(with_total='1', offset='10')
+        self.assertEqual(page, {'records': [], 'total': 5})
+
+    def test_total_with_cursor(self):
+        page = self.list(with_total='1', cursor='', limit='2')
+        self.assertEqual(page['total'], 5)
+        self.assertTrue(page['has_more'])
+
+class CountCacheTest(TestCase):
+    fixtures = ['testdata']
+
+    def setUp(self):
+        self.resource = site._registry['models/polls/choice/']
+        self.counts = self.resource.counts
+        self.resource.counts = CountCache('test/', Choice)
+
+    def tearDown(self):
+        self.resource.counts = self.counts
+
+    def length(self, **params):
+        return self.client.get('/api/models/polls/choice/length/', params)
+
+    def test_counts_are_cached(self):
+        self.assertEqual(self.length(conditions="votes = 0").content, '5')
+        self.assertNumQueries(0, self.length, conditions="votes = 0")
+        self.assertNumQueries(1, self.length, conditions="votes = 1")
+
+    def test_signals_invalidate(self):
+        self.assertEqual(self.length().content, '5')
+        Choice.objects.create(poll_id=1, answer='Black')
+        self.assertEqual(self.length().content, '6')
+        Choice.objects.get(answer='Black').delete()
+        self.assertEqual(self.length().content, '5')
+
+    def test_ttl(self):
+        self.resource.counts = CountCache('test/', Choice, ttl=0)
+        self.length()
+        time.sleep(0.01)
+        self.assertNumQueries(1, self.length)
+
+    def test_django_cache_backend(self):
+        self.resource.counts = CountCache('test/', Choice,
+            backend=DjangoCountCache())
+        self.assertEqual(self.length().content, '5')
+        self.assertNumQueries(0, self.length)
+        Choice.objects.create(poll_id=1, answer='Black')
+        self.assertEqual(self.length().content, '6')
+
+    def test_evicted_generations_dont_repeat(self):
+        backend = DjangoCountCache()
+        self.resource.counts = CountCache('test/', Choice, backend=backend)
+        self.assertEqual(self.length().content, '5')
+        Choice.objects.create(poll_id=1, answer='Black')
+        backend.cache.delete(backend.key_prefix + 'generation.polls.choice')
+        self.assertEqual(self.length().content, '6')
+
+class CountEstimateTest(TestCase):
+    fixtures = ['testdata']
+
+    def setUp(self):
+        self.resource = site._registry['models/polls/choice/']
+
+    def length(self, **params):
+        request = RequestFactory().get('/api/models/polls/choice/length/', params)
+        return self.resource.length(request)
+
+    def test_estimate(self):
+        self.assertEqual(self.length(), 5)
+        # The table fits into one sample, so the estimator counts it.
+        self.assertEqual(self.length(estimate='1'), {'count': 5, 'exact': True})
+
+    def test_sampled_estimate(self):
+        Choice.objects.bulk_create([Choice(poll_id=1, answer='Black')
+            for i in range(95)])
+        estimator = CountEstimator(sample_size=10)
+        estimate, exact = estimator.estimate(Choice.objects.all())
+        self.assertTrue(90 <= estimate <= 110, estimate)
+        self.assertFalse(exact)
+        self.assertEqual(estimator.estimate(
+            Choice.objects.filter(answer='Nothing')), (0, False))
+
+    def test_timeout(self):
+        self.resource.count_timeout = 5
+        try:
+            self.assertEqual(self.length(), {'count': 5, 'exact': True})
+            Choice.objects.bulk_create([Choice(poll_id=1, answer='Black')
+                for i in range(5000)])
+            self.assertEqual(timed_count(Choice.objects.filter(votes=0), -1),
+                None)
+        finally:
+            self.resource.count_timeout = None
+
+class FieldProjectionTest(TestCase):
+    fixtures = ['testdata']
+
+    def setUp(self):
+        self.resource = site._registry['models/polls/choice/']
+
+    def get(self, view, **params):
+        request = RequestFactory().get('/api/models/polls/choice/%s/' % view,
+            params)
+        return getattr(self.resource, view)(request)
+
+    def test_list(self):
+        records = self.get('list', fields='answer', ordering='answer')
+        self.assertEqual(records[0]['fields'], {'answer': u'Blue'})
+        self.assertEqual(len(records), 5)
+
+    def test_keys_only(self):
+        records = self.get('list', fields='pk', ordering='answer')
+        self.assertEqual(records[0], {'pk': 1, 'model': u'polls.choice',
+            'fields': {}})
+        self.assertEqual(self.get('show', pk='1', fields='pk')[0]['fields'], {})
+        self.resource.row_serializers = False
+        try:
+            records = self.get('list', fields='pk', ordering='answer')
+            self.assertEqual(records[0]['fields'], {})
+        finally:
+            del self.resource.row_serializers
+
+    def test_only_requested_columns_are_loaded(self):
+        qs = self.resource.project_query_set(Choice.objects.select_related(),
+            ['answer', 'poll'])
+        sql = str(qs.query)
+        self.assertTrue('votes' not in sql and 'polls_poll' not in sql, sql)
+
+    def test_pages_and_show(self):
+        page = self.get('list', fields='votes', cursor='', limit='2')
+        self.assertEqual(page['records'][0]['fields'], {'votes': 0})
+        page = self.get('list', fields='votes', with_total='1', limit='2')
+        self.assertEqual(page['records'][0]['fields'], {'votes': 0})
+        records = self.get('show', fields='poll,answer', pk='2')
+        self.assertEqual(records[0]['fields'], {'poll': 1, 'answer': u'Red'})
+
+    def test_unknown_fields(self):
+        self.assertEqual(self.get('list', fields='secret').ops['status'], 400)
+        self.resource.fields = ('answer',)
+        try:
+            self.assertEqual(self.get('show', fields='votes',
+                pk='1').ops['status'], 400)
+        finally:
+            self.resource.fields = ()
+
+class RelationPlannerTest(TestCase):
+    fixtures = ['testdata']
+
+    def test_plans(self):
+        plan = RelationPlanner(Choice).plan('{"poll": {}}')
+        self.assertEqual((plan.select, plan.prefetch), (('poll',), ()))
+        plan = RelationPlanner(Poll).plan(
+            '{"choice_set": {"relations": ["poll"]}}')
+        self.assertEqual((plan.select, plan.prefetch),
+            ((), ('choice_set', 'choice_set__poll')))
+
+    def test_plans_are_cached(self):
+        planner = RelationPlanner(Choice)
+        self.assertTrue(planner.plan('["poll"]') is planner.plan('["poll"]'))
+
+    def test_bounded_queries(self):
+        qs = RelationPlanner(Poll).plan(
+            '{"choice_set": {"relations": ["poll"]}}').apply(Poll.objects.all())
+        def serialize():
+            for poll in qs:
+                for choice in poll.choice_set.all():
+                    choice.poll.question
+        self.assertNumQueries(3, serialize)
+        qs = RelationPlanner(Choice).plan('["poll"]').apply(Choice.objects.all())
+        self.assertNumQueries(1, lambda: [c.poll.question for c in qs])
+
+    def test_invalid_specs(self):
+        planner = RelationPlanner(Choice)
+        for spec in ('{', '["votes"]', '["choice_set"]', '5'):
+            self.assertRaises(QueryError, planner.plan, spec)
+        response = self.client.get('/api/models/polls/choice/list/',
+            {'relations': '["nothing"]'})
+        self.assertEqual(response.status_code, 400)
+
+class StreamingListTest(TestCase):
+    fixtures = ['testdata']
+
+    def list(self, **params):
+        return self.client.get('/api/models/polls/choice/list/', params)
+
+    def test_stream(self):
+        resource = site._registry['models/polls/choice/']
+        resource.stream_batch_size = 2
+        try:
+            response = self.list(stream='1', ordering='answer')
+        finally:
+            resource.stream_batch_size = 100
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(simplejson.loads(response.content),
+            simplejson.loads(self.list(ordering='answer').content))
+        self.assertEqual(simplejson.loads(self.list(stream='1',
+            fields='answer', conditions="votes = 1").content), [])
+
+    def test_status(self):
+        response = self.list(stream='1', conditions="answer = ")
+        self.assertEqual(response.status_code, 400)
+
+    def test_stream_json(self):
+        self.assertEqual(''.join(stream_json(iter([]))), '[]')
+        chunks = list(stream_json(iter(range(5)), chunk_size=2))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(simplejson.loads(''.join(chunks)), range(5))
+
+class RangesTest(TestCase):
+    fixtures = ['testdata']
+
+    def setUp(self):
+        self.resource = site._registry['models/polls/choice/']
+
+    def ranges(self, **params):
+        response = self.client.get('/api/models/polls/choice/ranges/', params)
+        return response.status_code, simplejson.loads(response.content)
+
+    def answers(self, response):
+        return [[r['fields']['answer'] for r in rng['records']]
+            for rng in response['ranges']]
+
+    def test_ranges(self):
+        status, response = self.ranges(ranges='3:1,0:2', ordering='answer',
+            with_total='1')
+        self.assertEqual(status, 200)
+        self.assertEqual([r['offset'] for r in response['ranges']], [0, 3])
+        self.assertEqual(self.answers(response), [['Blue', 'Gray'], ['Red']])
+        self.assertEqual(response['total'], 5)
+
+    def test_ranges_are_merged(self):
+        self.resource.range_gap = 1
+        try:
+            self.assertEqual(self.resource.merge_ranges([(3, 1), (0, 2), (10, 5)],
+                QueryCost()), [(0, 4, [(0, 2), (3, 1)]), (10, 15, [(10, 5)])])
+            self.assertNumQueries(1, self.ranges, ranges='0:2,3:2')
+        finally:
+            self.resource.range_gap = 100
+
+    def test_posted_ranges(self):
+        response = self.client.post('/api/models/polls/choice/ranges/',
+            '{"ranges": [[1, 1]], "conditions": "answer != \'Green\'", '
+            '"ordering": "answer"}', content_type='application/json')
+        self.assertEqual(self.answers(simplejson.loads(response.content)),
+            [['Gray']])
+
+    def test_bad_ranges(self):
+        for ranges in ('', '1', '1:x', '-1:5', ','.join(['0:1'] * 21)):
+            self.assertEqual(self.ranges(ranges=ranges)[0], 400)
+
+class BulkShowTest(TestCase):
+    fixtures = ['testdata']
+
+    def bulk(self, data):
+        response = self.client.post('/api/models/polls/choice/bulk/',
+            simplejson.dumps(data), content_type='application/json')
+        return response.status_code, simplejson.loads(response.content)
+
+    def test_order_and_missing(self):
+        status, response = self.bulk({'pks': [4, '2', 99, 4, 1],
+            'fields': 'answer'})
+        self.assertEqual(status, 200)
+        self.assertEqual([r['pk'] for r in response['records']], [4, 2, 1])
+        self.assertEqual(response['records'][0]['fields'], {'answer': 'White'})
+        self.assertEqual(response['missing'], [99])
+
+    def test_chunks(self):
+        resource = site._registry['models/polls/choice/']
+        resource.in_chunk_size = 2
+        try:
+            self.assertNumQueries(3, self.bulk, {'pks': [5, 4, 3, 2, 1]})
+        finally:
+            resource.in_chunk_size = 500
+
+    def test_form_post(self):
+        response = self.client.post('/api/models/polls/choice/bulk/',
+            {'pk': ['3', '1']})
+        self.assertEqual([r['pk'] for r in
+            simplejson.loads(response.content)['records']], [3, 1])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.bulk({'pks': []})[0], 400)
+        self.assertEqual(self.bulk({'pks': 1})[0], 400)
+        self.assertEqual(self.bulk({'pks': ['x']})[0], 400)
+        self.assertEqual(self.bulk({'pks': [1], 'fields': 'secret'})[0], 400)
+
+class ConditionalGetTest(TestCase):
+    fixtures = ['testdata']
+
+    def list(self, **headers):
+        return self.client.get('/api/models/polls/choice/list/',
+            {'ordering': 'answer'}, **headers)
+
+    def test_etag(self):
+        response = self.list()
+        etag = response['ETag']
+        self.assertEqual(self.list(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get('/api/models/polls/choice/length/',
+            HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        Choice.objects.create(poll_id=1, answer='Black')
+        response = self.list(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_last_modified(self):
+        response = self.list()
+        self.assertEqual(self.list(HTTP_IF_MODIFIED_SINCE=
+            response['Last-Modified']).status_code, 304)
+        self.assertEqual(self.list(HTTP_IF_MODIFIED_SINCE=
+            'Sat, 01 Jan 2000 00:00:00 GMT').status_code, 200)
+
+    def test_not_modified_skips_the_handler(self):
+        etag = self.list()['ETag']
+        self.assertNumQueries(0, self.list, HTTP_IF_NONE_MATCH=etag)
+
+    def test_errors_are_not_validated(self):
+        response = self.client.get('/api/models/polls/choice/list/',
+            {'conditions': 'votes ='})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.has_header('ETag'))
+
+class RowSerializerTest(TestCase):
+    fixtures = ['testdata']
+
+    def test_matches_the_serializer(self):
+        for qs in (Choice.objects.all(), Poll.objects.all()):
+            expected = deconstruct(serialize('json', qs))
+            serializer = RowSerializer(qs.model)
+            self.assertEqual(serializer.serialize(qs), expected)
+            self.assertEqual(serializer.serialize(list(qs)), expected)
+        self.assertEqual(RowSerializer(Choice, ['answer']).serialize(
+            Choice.objects.get(pk=1)), deconstruct(serialize('json',
+            Choice.objects.filter(pk=1), fields=['answer'])))
+
+    def test_list_uses_values(self):
+        response = self.client.get('/api/models/polls/choice/list/')
+        self.assertEqual(simplejson.loads(response.content),
+            deconstruct(serialize('json', Choice.objects.all())))
+        resource = site._registry['models/polls/choice/']
+        serializer = resource.get_row_serializer()
+        self.assertTrue(serializer is resource.get_row_serializer())
+        def stream():
+            return self.client.get('/api/models/polls/choice/list/',
+                {'stream': '1'}).content
+        self.assertNumQueries(1, stream)
+
+class DeconstructTest(TestCase):
+    def test_types(self):
+        now = datetime.datetime(2010, 1, 1)
+        data = {'a': [1, 2L, 1.5, True, None, 'x', u'y', now],
+            'b': (decimal.Decimal('1.50'), set([3])), 'c': lambda: 1}
+        self.assertEqual(deconstruct(data), {'a': [1, 2L, 1.5, True, None,
+            u'x', u'y', now], 'b': ['1.50', [3]], 'c': None})
+        self.assertTrue(type(deconstruct('x')) is unicode)
+
+    def test_primitive_lists_are_not_walked(self):
+        records = PrimitiveList([{'pk': 1}])
+        self.assertTrue(deconstruct(records) is records)
+        self.assertTrue(type(RowSerializer(Poll).serialize([])) is PrimitiveList)
+
+class JSONEncodingTest(TestCase):
+    fixtures = ['testdata']
+
+    def list(self, **params):
+        params['ordering'] = 'answer'
+        return self.client.get('/api/models/polls/choice/list/', params).content
+
+    def test_compact_and_pretty(self):
+        compact = self.list()
+        self.assertTrue(compact.startswith('[{"') and '\n' not in compact)
+        pretty = self.list(pretty='1')
+        self.assertTrue('\n    ' in pretty)
+        self.assertEqual(simplejson.loads(pretty), simplejson.loads(compact))
+        self.assertEqual(simplejson.loads(self.list(pretty='1', stream='1')),
+            simplejson.loads(compact))
+
+    def test_debug_is_pretty(self):
+        settings.DEBUG = True
+        try:
+            self.assertTrue('\n    ' in self.list())
+        finally:
+            settings.DEBUG = False
+
+    def test_encoder_backend(self):
+        self.assertTrue(load_json_encoder(
+            'djangocore.serialization.dump_json') is dump_json)
+        self.assertEqual(dump_json({'a': [1, u'\xe9']}), u'{"a":[1,"\xe9"]}')
+
+class YAMLTest(TestCase):
+    fixtures = ['testdata']
+
+    @skipUnless(yaml, "PyYAML is not installed")
+    def test_row_serialized_responses(self):
+        url = '/api/models/polls/choice/'
+        for path, params in (('list/', {}), ('list/', {'with_total': '1'}),
+            ('list/', {'layout': 'columns'}), ('', {'pk': '1'})):
+            params.update({'format': 'yaml', 'ordering': 'answer'})
+            response = self.client.get(url + path, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue('Blue' in response.content)
+
+class MsgpackTest(TestCase):
+    fixtures = ['testdata']
+
+    @skipUnless(msgpack, "msgpack is not installed")
+    def test_emitter(self):
+        response = self.client.get('/api/models/polls/choice/list/',
+            {'ordering': 'answer', 'format': 'msgpack'})
+        self.assertEqual(response['Content-Type'], 'application/x-msgpack')
+        records = msgpack.unpackb(response.content, raw=False)
+        self.assertEqual(records[0]['fields']['answer'], u'Blue')
+        self.assertEqual(load_msgpack(dump_msgpack({'at':
+            datetime.datetime(2010, 1, 2, 3, 4, 5), 'price':
+            decimal.Decimal('1.50')})), {'at': u'2010-01-02T03:04:05',
+            'price': u'1.50'})
+
+    @skipUnless(msgpack, "msgpack is not installed")
+    def test_mimer(self):
+        data = msgpack.packb({'question': u'Favorite color?',
+            'slug': 'favorite-color'}, use_bin_type=False)
+        response = self.client.post('/api/models/polls/poll/', data,
+            content_type='application/x-msgpack')
+        self.assertContains(response, 'Favorite color?')
+        response = self.client.post('/api/models/polls/poll/', '\xc1',
+            content_type='application/x-msgpack')
+        self.assertEqual(response.status_code, 400)
+
+class NegotiationTest(TestCase):
+    fixtures = ['testdata']
+
+    def list(self, **headers):
+        return self.client.get('/api/models/polls/choice/list/',
+            {'ordering': 'answer'}, **headers)
+
+    def test_accept(self):
+        self.assertEqual(parse_accept('text/html;q=0.5, application/json, '
+            'image/*;q=0'), ['application/json', 'text/html'])
+        self.assertEqual(emitter.format_for_accept(None), 'json')
+        self.assertEqual(emitter.format_for_accept('*/*'), 'json')
+        self.assertEqual(emitter.format_for_accept('image/png'), 'json')
+        self.assertEqual(emitter.format_for_accept(
+            'application/json;q=0.5, text/xml'), 'xml')
+        self.assertEqual(emitter.format_for_accept('text/*'), 'xml')
+
+        response = self.list(HTTP_ACCEPT='text/xml')
+        self.assertTrue(response['Content-Type'].startswith('text/xml'))
+        self.assertTrue('Accept' in response['Vary'])
+        # ?format= overrides the header.
+        response = self.client.get('/api/models/polls/choice/list/',
+            {'format': 'json'}, HTTP_ACCEPT='text/xml')
+        self.assertTrue(response['Content-Type'].startswith('application/json'))
+
+    def test_compression(self):
+        plain = self.list().content
+        self.assertEqual(emitter.encoding_for_accept('gzip;q=0, deflate'),
+            'deflate')
+        self.assertEqual(emitter.encoding_for_accept('identity'), None)
+
+        resource = site._registry['models/polls/choice/']
+        resource.compress_min_size = 0
+        try:
+            response = self.list(HTTP_ACCEPT_ENCODING='gzip, deflate')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(zlib.decompress(response.content,
+                16 + zlib.MAX_WBITS), plain)
+            response = self.list(HTTP_ACCEPT_ENCODING='deflate')
+            self.assertEqual(zlib.decompress(response.content), plain)
+
+            response = self.client.get('/api/models/polls/choice/list/',
+                {'ordering': 'answer', 'stream': '1'},
+                HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(zlib.decompress(response.content,
+                16 + zlib.MAX_WBITS), plain)
+        finally:
+            resource.compress_min_size = 1024
+        # Small bodies are sent as they are.
+        response = self.list(HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+class XMLStreamTest(TestCase):
+    fixtures = ['testdata']
+
+    def test_chunks(self):
+        data = [{'pk': i, 'fields': {'answer': u'\xe9'}} for i in range(5)]
+        chunks = list(iter_xml(data, chunk_size=2))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(''.join(chunks), dump_xml(data))
+        self.assertTrue(chunks[-1].endswith('</resource></response>'))
+        # Records nested in a page are chunked as well.
+        page = {'records': [data[0]] * 1000, 'total': 1000}
+        chunks = list(iter_xml(page))
+        self.assertEqual(len(chunks), 11)
+        self.assertEqual(''.join(chunks), dump_xml(page))
+        self.assertEqual(dump_xml({'count': 5}), '<?xml version="1.0" '
+            'encoding="utf-8"?>\n<response><count>5</count></response>')
+
+    def test_list(self):
+        params = {'ordering': 'answer', 'format': 'xml'}
+        response = self.client.get('/api/models/polls/choice/list/', params)
+        self.assertTrue(response['Content-Type'].startswith('text/xml'))
+        content = response.content
+        self.assertTrue('<answer>Blue</answer>' in content)
+        params['stream'] = '1'
+        self.assertEqual(self.client.get('/api/models/polls/choice/list/',
+            params).content, content)
+
+    def test_compression(self):
+        resource = site._registry['models/polls/choice/']
+        params = {'ordering': 'answer', 'format': 'xml'}
+        plain = self.client.get('/api/models/polls/choice/list/',
+            params).content
+        for min_size, compressed in ((len(plain) + 1, False),
+            (len(plain), True), (0, True)):
+            resource.compress_min_size = min_size
+            try:
+                response = self.client.get('/api/models/polls/choice/list/',
+                    params, HTTP_ACCEPT_ENCODING='gzip')
+            finally:
+                resource.compress_min_size = 1024
+            content = response.content
+            self.assertEqual(response.has_header('Content-Encoding'),
+                compressed)
+            if compressed:
+                content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+            self.assertEqual(content, plain)
+
+class RequestBodyTest(TestCase):
+    fixtures = ['testdata']
+
+    def test_media_type(self):
+        self.assertEqual(parse_media_type('Application/JSON; charset="UTF-8"'),
+            ('application/json', {'charset': 'UTF-8'}))
+        self.assertTrue(mimer.mimer_for_ctype('application/json;charset=latin-1'))
+        response = self.client.post('/api/models/polls/poll/',
+            '{"question": "Favorite color?", "slug": "favorite-color"}',
+            content_type='APPLICATION/JSON; charset=utf-8')
+        self.assertContains(response, 'Favorite color?')
+
+    def test_max_body_size(self):
+        settings.SPROUTCORE_MAX_BODY_SIZE = 16
+        try:
+            response = self.client.post('/api/models/polls/poll/',
+                '{"question": "Favorite color?", "slug": "favorite-color"}',
+                content_type='application/json')
+            self.assertEqual(response.status_code, 413)
+            self.assertEqual(Poll.objects.filter(slug='favorite-color').count(), 0)
+        finally:
+            del settings.SPROUTCORE_MAX_BODY_SIZE
+
+class ColumnsLayoutTest(TestCase):
+    fixtures = ['testdata']
+
+    def list(self, **params):
+        params['ordering'] = 'answer'
+        return simplejson.loads(self.client.get(
+            '/api/models/polls/choice/list/', params).content)
+
+    def test_list(self):
+        records = self.list()
+        rows = self.list(layout='columns')
+        self.assertEqual(rows[0], {'model': 'polls.choice',
+            'columns': ['pk', 'poll', 'answer', 'votes']})
+        self.assertEqual(len(rows), len(records) + 1)
+        self.assertEqual(rows[1], [records[0]['pk']] + [records[0]['fields'][c]
+            for c in rows[0]['columns'][1:]])
+        self.assertEqual(self.list(layout='columns', stream='1'), rows)
+        self.assertEqual(self.list(layout='columns', fields='answer')[0]
+            ['columns'], ['pk', 'answer'])
+
+    def test_posted_options(self):
+        response = self.client.post('/api/models/polls/choice/list/',
+            simplejson.dumps({'ordering': 'answer', 'layout': 'columns',
+            'pretty': True}), content_type='application/json')
+        self.assertTrue('\n    ' in response.content)
+        self.assertEqual(simplejson.loads(response.content),
+            self.list(layout='columns'))
+
+        get = self.client.get('/api/models/polls/choice/list/',
+            {'ordering': 'answer', 'relations': '{"poll": {}}'})
+        post = self.client.post('/api/models/polls/choice/list/',
+            simplejson.dumps({'ordering': 'answer', 'relations': {'poll': {}}}),
+            content_type='application/json')
+        self.assertEqual(post.content, get.content)
+
+    def test_decoder(self):
+        from django.template.loader import render_to_string
+        rendered = render_to_string('djangocore/core.js', {'app_label': 'Polls'})
+        self.assertTrue('Polls.decodeRecords = function(records)' in rendered)